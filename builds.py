@@ -0,0 +1,502 @@
+"""Builds tools from their repos, using local caches and a resource-aware scheduler."""
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
+import hashlib
+import json
+import os
+import os.path as osp
+import shutil
+import subprocess
+from subprocess import PIPE, DEVNULL, STDOUT
+import threading
+import time
+
+from runner import run, RUNNER
+from targets import BIN_DIR, HOST_TARGET, TOOLS_DIR
+from tracing import TRACER
+
+__all__ = [
+    "BuildCache",
+    "CargoCache",
+    "SourceFetcher",
+    "BuildScheduler",
+    "dir_size",
+    "toolchain_version",
+    "plan_builds",
+    "build_tools",
+]
+
+LOGS_DIR = osp.join(TOOLS_DIR, "logs")
+BUILD_CACHE_DIR = osp.join(TOOLS_DIR, "build-cache")
+CARGO_CACHE_DIR = osp.join(TOOLS_DIR, "cargo-cache")
+BUILD_STATS_PATH = osp.join(TOOLS_DIR, "build-stats.json")
+# The commands used to identify the compiler of a builder, keyed by the builder's executable.
+TOOLCHAIN_VERSION_CMDS = {"cargo": "rustc --version", "go": "go version"}
+
+
+class BuildCache:
+    """A size-bounded, least-recently-used cache of tool binaries on the local disk.
+       Entries are addressed by a hash of everything that determines the build output."""
+
+    def __init__(self, cache_dir=BUILD_CACHE_DIR, max_size=4 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(tool, ver, target=HOST_TARGET):
+        """Returns the cache key of `tool` built at `ver` for `target` with the current
+           toolchain."""
+        builder = tool.builder or "cargo"
+        key_parts = [tool.name, ver, target.name, builder, toolchain_version(builder.split()[0])]
+        return hashlib.sha256("\0".join(key_parts).encode()).hexdigest()
+
+    def restore(self, key, dest):
+        """Copies the binary cached under `key` to `dest`. Returns whether it was cached."""
+        path = osp.join(self.cache_dir, key)
+        try:
+            shutil.copy(path, dest)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        os.utime(path)  # mtime records the last use
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, path):
+        """Adds the binary at `path` under `key` and evicts the least recently used
+           binaries that no longer fit."""
+        tmp_path = osp.join(self.cache_dir, f".{key}.{threading.get_ident()}")
+        shutil.copy(path, tmp_path)
+        os.replace(tmp_path, osp.join(self.cache_dir, key))
+        with self._lock:
+            entries = sorted(
+                (de.stat().st_mtime, de.stat().st_size, de.path)
+                for de in os.scandir(self.cache_dir)
+                if not de.name.startswith(".")
+            )
+            cache_size = sum(size for _, size, _ in entries)
+            for (_, size, entry_path) in entries:
+                if cache_size <= self.max_size:
+                    break
+                os.remove(entry_path)
+                cache_size -= size
+
+
+class CargoCache:
+    """A target dir and compiler-output cache shared by all Rust tools, so that the
+       dependencies they have in common are compiled once rather than once per repo and rev.
+       Compiler outputs are cached by `sccache`, if it is installed."""
+
+    def __init__(self, cache_dir=CARGO_CACHE_DIR, max_size=10 * 2 ** 30):
+        self.target_dir = osp.join(cache_dir, "target")
+        self.sccache_dir = osp.join(cache_dir, "sccache")
+        self.max_size = max_size
+        self.sccache = shutil.which("sccache")
+
+    def envs(self):
+        """Returns the env vars that route a cargo build through this cache."""
+        envs = {"CARGO_TARGET_DIR": self.target_dir}
+        if self.sccache:
+            envs["RUSTC_WRAPPER"] = self.sccache
+            envs["SCCACHE_DIR"] = self.sccache_dir
+            envs["SCCACHE_CACHE_SIZE"] = f"{self.max_size // 2 ** 20}M"
+        return envs
+
+    def start(self):
+        """Starts the sccache server with cleared stats, so they only cover this run."""
+        if self.sccache:
+            run(f"{self.sccache} --stop-server", envs=self.envs(), stdout=DEVNULL, check=False)
+            run(f"{self.sccache} --zero-stats", envs=self.envs(), stdout=DEVNULL)
+
+    def stop(self):
+        """Returns the sccache `(hits, misses)` of this run, if any, and stops the server.
+           Empties the target dir if it has outgrown its size limit."""
+        stats = None
+        if self.sccache:
+            stats_json = run(
+                f"{self.sccache} --show-stats --stats-format=json",
+                envs=self.envs(),
+                stdout=PIPE,
+                check=False,
+            ).stdout
+            run(f"{self.sccache} --stop-server", envs=self.envs(), stdout=DEVNULL, check=False)
+            try:
+                sccache_stats = json.loads(stats_json)["stats"]
+                stats = tuple(
+                    sum(sccache_stats[stat]["counts"].values())
+                    for stat in ("cache_hits", "cache_misses")
+                )
+            except (ValueError, KeyError, TypeError):
+                pass
+        if dir_size(self.target_dir) > self.max_size:
+            print(f"+ rm -rf {self.target_dir}")
+            shutil.rmtree(self.target_dir, ignore_errors=True)
+        return stats
+
+
+class SourceFetcher:
+    """Checks out tool repos while fetching as little as possible. `partial` clones fetch
+       blobs only when they are checked out, `shallow` clones fetch only the tip of master
+       and `full` clones fetch everything. Clones borrow objects from local bare mirrors
+       kept in `mirrors_dir`, if provided."""
+
+    CLONE_ARGS = {"full": "", "partial": "--filter=blob:none", "shallow": "--depth 1"}
+
+    def __init__(self, strategy="partial", mirrors_dir=None):
+        self.strategy = strategy
+        self.mirrors_dir = mirrors_dir
+
+    def checkout(self, source, ver, repo_dir, run_fn=None):
+        """Checks out `ver`, a rev of `source`'s master, into `repo_dir`."""
+        run_fn = run_fn or run
+        clone_args = self.CLONE_ARGS[self.strategy]
+        if self.mirrors_dir is not None:
+            mirror_dir = osp.join(self.mirrors_dir, f"{source.rsplit('/', 1)[-1]}.git")
+            if osp.isdir(mirror_dir):
+                run_fn("git fetch -q --prune origin", cwd=mirror_dir)
+            else:
+                run_fn(f"git clone -q --mirror {source} {mirror_dir}")
+            clone_args += f" --reference-if-able {mirror_dir}"
+
+        if not osp.isdir(repo_dir):
+            run_fn(f"git clone -q --no-checkout {clone_args} {source} {repo_dir}")
+        shallow = self.strategy == "shallow"
+        run_fn(f"git fetch -q {'--depth 1 ' if shallow else ''}origin master", cwd=repo_dir)
+        if run_fn(f"git checkout -q {ver}", cwd=repo_dir, check=False).returncode != 0:
+            # master has moved past `ver` since it was probed.
+            run_fn(f"git fetch -q {'--unshallow ' if shallow else ''}origin", cwd=repo_dir)
+            run_fn(f"git checkout -q {ver}", cwd=repo_dir)
+
+    @staticmethod
+    def worktree(repo_dir, ver, worktree_dir, run_fn=None):
+        """Checks out `ver`, which `repo_dir` has already fetched, into `worktree_dir`,
+           a worktree that shares the objects of `repo_dir`."""
+        run_fn = run_fn or run
+        if osp.isdir(worktree_dir):
+            run_fn(f"git checkout -q --force --detach {ver}", cwd=worktree_dir)
+        else:
+            run_fn("git worktree prune", cwd=repo_dir)
+            run_fn(f"git worktree add -q --force --detach {worktree_dir} {ver}", cwd=repo_dir)
+
+
+def dir_size(path):
+    """Returns the total size of the files under `path`."""
+    return sum(
+        osp.getsize(osp.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(path)
+        for filename in filenames
+        if not osp.islink(osp.join(dirpath, filename))
+    )
+
+
+@lru_cache(maxsize=None)
+def toolchain_version(builder_exe):
+    """Returns the version string of the compiler behind `builder_exe`, if known."""
+    version_cmd = TOOLCHAIN_VERSION_CMDS.get(builder_exe)
+    if version_cmd is None:
+        return ""
+    return run(version_cmd, stdout=PIPE, stderr=DEVNULL, check=False).stdout.strip()
+
+
+def plan_builds(tools, head_versions, cached_versions):
+    """Returns the builds that bring each target's cached tools up to `head_versions` as
+       `{ <source>: { <target>: [(<tool>, <ver>)] } }`, given the cached versions as
+       `{ <target>: { <tool name>: <ver> } }`. Planning all targets at once lets each
+       repo be fetched once for all of them."""
+    plan = {}
+    for target, target_cached_versions in cached_versions.items():
+        for name, ver in head_versions.items():
+            if target_cached_versions.get(name) != ver:
+                tool = tools[name]
+                plan.setdefault(tool.source, {}).setdefault(target, []).append((tool, ver))
+    return plan
+
+
+def build_tools(plan, cache=None, cargo_cache=None, fetcher=None, scheduler=None):
+    """Builds new tools or restores them from the `BuildCache`, following a `plan_builds`
+       plan. Each repo is checked out once and built for each target by the concurrent
+       workers of the `BuildScheduler`, which keeps them within the host's CPUs and
+       memory. Targets after the first are built in worktrees of the checkout, so that they
+       can be built at the same time. The output of each build is captured in
+       `LOGS_DIR/<repo>-<target>.log`. Rust tools are built using the `CargoCache`, if one
+       is provided, which is shared by all targets."""
+    if fetcher is None:
+        fetcher = SourceFetcher()
+    if scheduler is None:
+        scheduler = BuildScheduler()
+    if RUNNER.backend.executes:  # else the binaries of the last run are left be
+        shutil.rmtree(BIN_DIR, ignore_errors=True)
+    for target in {target for target_tool_vers in plan.values() for target in target_tool_vers}:
+        os.makedirs(target.bin_dir, exist_ok=True)
+    os.makedirs(LOGS_DIR, exist_ok=True)
+
+    build_jobs = _build_jobs(plan, fetcher, _RepoBuilder(scheduler, cache, cargo_cache))
+    if cargo_cache is not None:
+        cargo_cache.start()
+    try:
+        errors = scheduler.run(build_jobs)
+    finally:
+        if RUNNER.backend.executes:  # else the build times recorded are meaningless
+            scheduler.save()
+        _stop_caches(cache, cargo_cache)
+
+    if errors:
+        raise errors[0]
+
+
+def _build_jobs(plan, fetcher, builder):
+    """Returns the `BuildScheduler.Job`s that build the tools of a `plan_builds` plan that
+       can't be restored from the builder's `BuildCache`."""
+    build_jobs = []
+    for source, target_tool_vers in plan.items():
+        checkout = _RepoCheckout(source, fetcher)
+        for i, (target, tool_vers) in enumerate(target_tool_vers.items()):
+            if builder.cache is not None:
+                tool_vers = _restore_cached(tool_vers, target, builder.cache)
+            if tool_vers:
+                build_jobs.append(
+                    BuildScheduler.Job(
+                        f"{source} for {target.name}",
+                        [(tool, target) for (tool, _) in tool_vers],
+                        partial(builder.build, tool_vers, target, i, checkout),
+                    )
+                )
+    return build_jobs
+
+
+def _stop_caches(cache, cargo_cache):
+    """Stops the `CargoCache`, if any, and prints the hits and misses of the caches."""
+    summary = []
+    if cache is not None:
+        summary.append(f"build cache: {cache.hits} hits, {cache.misses} misses")
+    sccache_stats = cargo_cache.stop() if cargo_cache is not None else None
+    if sccache_stats is not None:
+        summary.append("compiler cache: %d hits, %d misses" % sccache_stats)
+    if summary:
+        print("; ".join(summary))
+
+
+def _restore_cached(tool_vers, target, cache):
+    """Restores the cached `tool_vers` built for `target` and returns the others."""
+    uncached_tool_vers = []
+    for (tool, ver) in tool_vers:
+        if cache.restore(cache.key(tool, ver, target), osp.join(target.bin_dir, tool.name)):
+            print(f"+ restored {tool.name}-{ver} for {target.name} from the build cache")
+        else:
+            uncached_tool_vers.append((tool, ver))
+    return uncached_tool_vers
+
+
+class BuildScheduler:
+    """Runs up to `max_jobs` build jobs concurrently while the CPUs and memory that they are
+       expected to use fit within the host's. Each tool takes the `cpus` and `memory` declared
+       in the config or, failing that, the defaults of its kind of build. Jobs that are
+       expected to take longest, judging by the build times recorded in `stats_path`, are
+       started first, and of those expected to take as long, e.g. because they haven't been
+       timed, the lightest."""
+
+    Job = namedtuple("Job", "name tool_targets build_fn")  # `build_fn(envs)`
+
+    # Cargo would use every core, but that would leave no room for other builds.
+    CARGO_CPU_SHARE = 0.5
+    CARGO_MEMORY = 2  # GiB
+    DEFAULT_CPUS = 1
+    DEFAULT_MEMORY = 0.5  # GiB
+    # Jobs whose tools have not been timed yet are assumed to be long.
+    UNTIMED_SECS = float("inf")
+
+    def __init__(self, cpus=None, memory=None, max_jobs=1, stats_path=BUILD_STATS_PATH):
+        self.cpus = cpus or os.cpu_count()
+        self.memory = memory or os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2 ** 30
+        self.max_jobs = max(max_jobs, 1)
+        self.stats_path = stats_path
+        self._lock = threading.Lock()
+        try:
+            with open(stats_path) as f_stats:
+                self._build_secs = json.load(f_stats)
+        except (FileNotFoundError, ValueError):
+            self._build_secs = {}
+
+    def resources(self, tool):
+        """Returns the `(cpus, GiB of memory)` that building `tool` is expected to use."""
+        if tool.builder is None:
+            default_cpus = max(self.cpus * self.CARGO_CPU_SHARE, 1)
+            default_memory = self.CARGO_MEMORY
+        else:
+            default_cpus, default_memory = self.DEFAULT_CPUS, self.DEFAULT_MEMORY
+        cpus = min(tool.cpus or default_cpus, self.cpus)
+        return cpus, min(tool.memory or default_memory, self.memory)
+
+    def job_resources(self, job):
+        """Returns the `(cpus, GiB of memory)` reserved for `job`, whose tools are built
+           one after another."""
+        tool_resources = [self.resources(tool) for (tool, _) in job.tool_targets]
+        return max(cpus for cpus, _ in tool_resources), max(mem for _, mem in tool_resources)
+
+    def expected_secs(self, job):
+        """Returns how long `job` is expected to take."""
+        return sum(
+            self._build_secs.get(f"{tool.name}@{target.name}", self.UNTIMED_SECS)
+            for (tool, target) in job.tool_targets
+        )
+
+    def priority(self, job):
+        """Returns the key by which jobs are started, highest first."""
+        return self.expected_secs(job), -self.job_resources(job)[0]
+
+    @staticmethod
+    def job_envs(cpus):
+        """Returns the env vars that limit the parallelism of a job to `cpus`."""
+        parallelism = str(max(int(cpus), 1))
+        return {"CARGO_BUILD_JOBS": parallelism, "GOMAXPROCS": parallelism}
+
+    def record(self, tool, target, secs):
+        """Records that building `tool` for `target` took `secs` seconds."""
+        with self._lock:
+            self._build_secs[f"{tool.name}@{target.name}"] = secs
+
+    def run(self, jobs):
+        """Runs the `jobs` and returns the errors raised. A job that does not fit even on an
+           idle host is run alone."""
+        pending = sorted(jobs, key=self.priority, reverse=True)
+        running = {}  # future: (cpus, memory)
+        free_cpus, free_memory = self.cpus, self.memory
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as pool:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self.max_jobs:
+                        break
+                    cpus, memory = self.job_resources(job)
+                    if running and (cpus > free_cpus or memory > free_memory):
+                        continue
+                    pending.remove(job)
+                    free_cpus, free_memory = free_cpus - cpus, free_memory - memory
+                    print(f"+ building {job.name} with {cpus:g} CPUs, {memory:g} GiB")
+                    running[pool.submit(job.build_fn, self.job_envs(cpus))] = (cpus, memory)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for build in done:
+                    cpus, memory = running.pop(build)
+                    free_cpus, free_memory = free_cpus + cpus, free_memory + memory
+                    if build.exception() is not None:
+                        errors.append(build.exception())
+        return errors
+
+    def save(self):
+        """Writes the recorded build times to the stats file."""
+        with self._lock:
+            build_secs = dict(self._build_secs)
+        os.makedirs(osp.dirname(self.stats_path), exist_ok=True)
+        with open(f"{self.stats_path}.tmp", "w") as f_stats:
+            json.dump(build_secs, f_stats, indent=2, sort_keys=True)
+        os.replace(f"{self.stats_path}.tmp", self.stats_path)
+
+
+class _RepoCheckout:
+    """The checkout of a tool repo that's shared by the builds of all targets. The repo is
+       fetched by the first build that needs it, and each later target gets a worktree."""
+
+    def __init__(self, source, fetcher):
+        self.source = source
+        self.repo_dir = osp.join(TOOLS_DIR, source.rsplit("/", 1)[-1])
+        self._fetcher = fetcher
+        self._lock = threading.Lock()
+        self._checked_out = False
+
+    def build_dir(self, ver, target_index, run_fn):
+        """Returns the dir in which to build the `target_index`th target of the plan."""
+        with self._lock:
+            if not self._checked_out:
+                self._fetcher.checkout(self.source, ver, self.repo_dir, run_fn=run_fn)
+                self._checked_out = True
+            if target_index == 0:
+                return self.repo_dir
+            worktree_dir = f"{self.repo_dir}@{target_index}"
+            self._fetcher.worktree(self.repo_dir, ver, worktree_dir, run_fn=run_fn)
+            return worktree_dir
+
+
+class _RepoBuilder:
+    """Builds the tools of repos, recording how long each took with the `BuildScheduler`
+       and storing them in the `BuildCache` and Rust build outputs in the `CargoCache`, if
+       there are any."""
+
+    def __init__(self, scheduler, cache=None, cargo_cache=None):
+        self.scheduler = scheduler
+        self.cache = cache
+        self.cargo_cache = cargo_cache
+
+    def build(self, tool_vers, target, target_index, checkout, envs):
+        """Builds tools that share a repo for `target` without changing the process cwd.
+           `envs` limit the parallelism of the build."""
+        ver = tool_vers[0][1]
+        log_path = osp.join(LOGS_DIR, f"{osp.basename(checkout.repo_dir)}-{target.name}.log")
+
+        with open(log_path, "w") as f_log, TRACER.span(
+            f"build {checkout.source} for {target.name}",
+            "build",
+            tools=[tool.name for (tool, _) in tool_vers],
+        ):
+
+            def _run(cmd, **run_args):
+                f_log.write(f"+ {cmd}\n")
+                f_log.flush()
+                return run(cmd, stdout=f_log, stderr=STDOUT, **run_args)
+
+            try:
+                build_dir = checkout.build_dir(ver, target_index, _run)
+                for (tool, _) in tool_vers:
+                    build_start = time.perf_counter()
+                    self._copy_built(self._build_tool(tool, target, build_dir, _run, envs), target)
+                    if not RUNNER.backend.executes:
+                        continue
+                    self.scheduler.record(tool, target, time.perf_counter() - build_start)
+                    if self.cache is not None:
+                        self.cache.store(
+                            self.cache.key(tool, ver, target), osp.join(target.bin_dir, tool.name)
+                        )
+            except (RuntimeError, OSError, subprocess.CalledProcessError):
+                with open(log_path) as f_build_log:
+                    print(
+                        f"! build of {checkout.source} for {target.name} failed:\n"
+                        + f_build_log.read()
+                    )
+                raise
+
+    @staticmethod
+    def _copy_built(path, target):
+        if RUNNER.backend.executes:  # else there's nothing checked out or built
+            shutil.copy(path, target.bin_dir)
+
+    def _build_tool(self, tool, target, build_dir, run_fn, envs):
+        """Builds `tool` for `target` in `build_dir` and returns the path of the binary."""
+        if tool.builder is not None:
+            run_fn(tool.builder, cwd=build_dir, envs={**target.build_envs(), **envs})
+            return osp.join(build_dir, tool.name)
+        if osp.isfile(osp.join(build_dir, "Cargo.toml")) or not RUNNER.backend.executes:
+            target_dir = osp.join(build_dir, "target")
+            cargo_envs = envs
+            if self.cargo_cache is not None:
+                target_dir = self.cargo_cache.target_dir
+                cargo_envs = {**self.cargo_cache.envs(), **envs}
+            cargo_target = ""
+            if target != HOST_TARGET:
+                target_dir = osp.join(target_dir, target.rust_triple)
+                cargo_target = f"--target {target.rust_triple} "
+            run_fn(
+                f"cargo build -q --locked --release {cargo_target}--bin {tool.name}",
+                cwd=build_dir,
+                envs=cargo_envs,
+            )
+            return osp.join(target_dir, "release", tool.name)
+        if osp.isfile(osp.join(build_dir, "go.mod")):
+            raise RuntimeError("auto go build are not yet supported. please specify `builder`")
+        raise RuntimeError("unable to auto-detect project type")
@@ -4,16 +4,28 @@ This script lives in https://github.com/oasislabs/toolstate.
 """
 
 import argparse
+import glob
+import hashlib
+import json
 import os
 import os.path as osp
 import platform
 import re
 import shlex
+import shutil
 import subprocess
 import sys
+import threading
+import time
+
+try:
+    import lzma
+except ImportError:  # Python 2 relies on the `xz` utility instead.
+    lzma = None  # pylint: disable=invalid-name
 
 TOOLS_URL = "http://tools.oasis.dev.s3-us-west-2.amazonaws.com"
 NODE_DIST_URL = "https://nodejs.org/dist/{ver}/node-{ver}-{plat}-x64.tar.gz"
+RUSTUP_INIT_URL = "https://sh.rustup.rs"
 RUST_VER = "nightly-2019-08-26"
 REQUIRED_UTILS = ["cc", "ld", "curl", "git"]
 # Library dependencies matrix.
@@ -24,7 +36,17 @@ PLAT_DARWIN = "darwin"
 PLAT_LINUX = "linux"
 RUST_SYSROOT_PREFIX = "toolchains/%s-x86_64-" % RUST_VER
 INSTALLED_DEPS_FILE = "installed_dependencies"
+INSTALLER_STATE_FILE = "installer_state.json"
+# Tool binaries are also published xz-compressed and as xdelta3 patches of their previous version.
+XZ_SUFFIX = ".xz"
+DELTA_SUFFIX = ".xd3"
+# Channels are the prefixes that tools are released under, except for these aliases.
+CURRENT_CHANNEL = "current"
+CHANNEL_PREFIXES = {"latest": CURRENT_CHANNEL, "unstable": CURRENT_CHANNEL}
+DOWNLOAD_ATTEMPTS = 3
+CURL_CANNOT_RESUME = 33
 DEVNULL = open("/dev/null", "w")
+_TASK = threading.local()  # Holds the `log` of the task running on a thread.
 
 
 def main():
@@ -123,7 +145,50 @@ def _ensure_dir(path):
 
 
 def install(args, env_info):
-    installed_deps_path = osp.join(env_info.data_dir, INSTALLED_DEPS_FILE)
+    record_install = _install_recorder(osp.join(env_info.data_dir, INSTALLED_DEPS_FILE))
+    state = InstallerState(osp.join(env_info.data_dir, INSTALLER_STATE_FILE))
+    downloader = Downloader(osp.join(env_info.data_dir, "downloads"))
+
+    def bin_dir(*x):
+        return osp.join(args.bin_dir, *x)
+
+    def _install_oasis():
+        oasis_cli = download_oasis(args, env_info, downloader, bin_dir("oasis"))
+        install_oasis(args, oasis_cli)
+        # The downloaded CLI was checked against its sha256, by which it's cached.
+        state.record("oasis", bin_dir("oasis"), True, sha256=osp.basename(oasis_cli))
+
+    def _install_node():
+        if node_package_manager(env_info):
+            node_ver = install_node(args, env_info)
+        else:
+            node_ver = install_node(args, env_info, *download_node(env_info, downloader))
+        record_install("node-%s" % node_ver)
+
+    # Each task is `(description, dependencies, function)`, listed after its dependencies.
+    tasks = [] if args.no_rust else rust_tasks(args, env_info, downloader, record_install)
+    if not args.no_node and needs_node(args, state):
+        tasks.append(("Node", [], _install_node))
+    has_oasis_install = osp.isfile(bin_dir("oasis-chain")) and is_oasis(bin_dir("oasis"), state)
+    needs_oasis = args.force or not has_oasis_install
+    if needs_oasis and not args.force and osp.exists(bin_dir("oasis")):
+        raise RuntimeError("`%s` already exists!" % bin_dir("oasis"))
+    if needs_oasis:
+        tasks.append(("the Oasis toolchain", [], _install_oasis))
+
+    try:
+        run_tasks(tasks, _ensure_dir(osp.join(env_info.data_dir, "logs")))
+    finally:
+        state.save()
+    print("")
+    if not needs_oasis:
+        print_header("The Oasis toolchain is already installed.")
+        print("Run `oasis set-toolchain latest` to update.\n")
+
+
+def _install_recorder(installed_deps_path):
+    """Returns a function that records installed tools so that they can be uninstalled later.
+       Tools that were already recorded when the installer started aren't recorded again."""
     preinstalled_deps = set()
     if osp.isfile(installed_deps_path):
         with open(installed_deps_path) as f_installed:
@@ -132,64 +197,112 @@ def install(args, env_info):
         with open(installed_deps_path, "w") as _:
             pass
 
+    record_lock = threading.Lock()
+
     def _record_install(dep):
-        """Record installed tool so that they can be uninstalled later."""
         if dep in preinstalled_deps:
             return
-        with open(installed_deps_path, "a") as f_installed:
+        with record_lock, open(installed_deps_path, "a") as f_installed:
             f_installed.write(dep + "\n")
 
-    has_rust_install = which("rustup")
-    if not args.no_rust and (args.force or not has_rust_install):
-        print_header("Installing Rust")
-        install_rust()
-        _record_install("rust")
-        print("")
-    if not args.no_rust:
-        rustup_bin = osp.join(env_info.cargo_home, "bin", "rustup")
-        run("%s toolchain install %s" % (rustup_bin, RUST_VER), silent=True)
-        run("%s target add wasm32-wasi --toolchain %s" % (rustup_bin, RUST_VER), silent=True)
+    return _record_install
 
-    def bin_dir(*x):
-        return osp.join(args.bin_dir, *x)
 
-    def get_node_version():
-        """Returns the un-prefixed semver of the Node.js executable."""
-        # Node executable on Ubuntu <=17.10 is named nodejs.
-        for node_exe in ["node", "nodejs"]:
-            # Node executables might be in ~/.local/bin but not on PATH.
-            if not which(node_exe):
-                node_exe = bin_dir(node_exe)
-            if which(node_exe):
-                # Trim-off leading "v".
-                return run("%s --version" % node_exe, capture=True)[1:]
-
-        return ""
-
-    if not args.no_node:
-        node_version = get_node_version()
-        if node_version and not args.force and not semver_greater_or_equal(node_version,
-                                                                           REQUIRED_NODE_VERSION):
-            raise RuntimeError(
-                "Node version %s found, but minimum required version is %s. Please remove \
-locally installed node."
-                % (node_version, REQUIRED_NODE_VERSION)
+def rust_tasks(args, env_info, downloader, record_install):
+    """Returns the tasks that install whichever of rustup, the Rust toolchain and its
+       wasm32-wasi target are missing."""
+    needs_rust = args.force or not which("rustup")
+    # Checking for the toolchain's files is much faster than asking rustup to install it.
+    needs_rust_toolchain = needs_rust or not glob.glob(
+        osp.join(env_info.rustup_home, RUST_SYSROOT_PREFIX + "*", "lib", "rustlib", "wasm32-wasi")
+    )
+    rustup_bin = osp.join(env_info.cargo_home, "bin", "rustup")
+
+    def _install_rust():
+        install_rust(downloader.download(RUSTUP_INIT_URL))
+        record_install("rust")
+
+    tasks = []
+    if needs_rust:
+        tasks.append(("Rust", [], _install_rust))
+    if needs_rust_toolchain:
+        tasks.append(
+            (
+                "the Rust %s toolchain" % RUST_VER,
+                ["Rust"] if needs_rust else [],
+                lambda: run("%s toolchain install %s" % (rustup_bin, RUST_VER), silent=True),
+            )
+        )
+        tasks.append(
+            (
+                "the wasm32-wasi target",
+                ["the Rust %s toolchain" % RUST_VER],
+                lambda: run(
+                    "%s target add wasm32-wasi --toolchain %s" % (rustup_bin, RUST_VER),
+                    silent=True,
+                ),
             )
+        )
+    return tasks
 
-        if args.force or not node_version:
-            print_header("Installing Node")
-            node_ver = install_node(args, env_info)
-            _record_install("node-%s" % node_ver)
-            print("")
 
-    has_oasis_install = osp.isfile(bin_dir("oasis-chain")) and is_oasis(bin_dir("oasis"))
-    if args.force or not has_oasis_install:
-        print_header("Installing the Oasis toolchain...")
-        install_oasis(args, env_info)
-        print("")
-    else:
-        print_header("The Oasis toolchain is already installed.")
-        print("Run `oasis set-toolchain latest` to update.\n")
+def needs_node(args, state):
+    """Returns whether Node should be installed. Raises if an older one is installed."""
+    node_version = get_node_version(args.bin_dir, state)
+    if node_version and not args.force and not semver_greater_or_equal(node_version,
+                                                                       REQUIRED_NODE_VERSION):
+        raise RuntimeError(
+            "Node version %s found, but minimum required version is %s. Please remove \
+locally installed node."
+            % (node_version, REQUIRED_NODE_VERSION)
+        )
+    return args.force or not node_version
+
+
+def get_node_version(bin_dir, state):
+    """Returns the un-prefixed semver of the Node.js executable."""
+    # Node executable on Ubuntu <=17.10 is named nodejs.
+    for node_exe in ["node", "nodejs"]:
+        # Node executables might be in ~/.local/bin but not on PATH.
+        node_path = which(node_exe) or which(osp.join(bin_dir, node_exe))
+        if node_path:
+            # Trim-off leading "v".
+            return state.probe(
+                "node", node_path, lambda path: run("%s --version" % path, capture=True)[1:]
+            )
+
+    return ""
+
+
+def run_tasks(tasks, logs_dir):
+    """Runs the `(description, dependencies, function)` tasks concurrently, each once
+       the tasks it depends on have succeeded. Progress is printed as tasks start and finish,
+       and the output of each task's commands goes to its own log in `logs_dir`."""
+    print_lock = threading.Lock()
+
+    def _run_task(desc, deps, task_fn):
+        for dep in deps:
+            started[dep].result()
+        log_path = osp.join(logs_dir, re.sub(r"\W+", "-", desc.lower()).strip("-") + ".log")
+        with print_lock:
+            print_header("Installing %s..." % desc)
+        start_time = time.time()
+        with open(log_path, "w") as _TASK.log:
+            try:
+                task_fn()
+            except (OSError, RuntimeError, subprocess.CalledProcessError) as err:
+                # pylint: disable=raise-missing-from
+                raise RuntimeError("Unable to install %s: %s (see %s)" % (desc, err, log_path))
+            finally:
+                _TASK.log = None
+        with print_lock:
+            print_info("Installed %s in %.1fs." % (desc, time.time() - start_time))
+
+    started = {}
+    for desc, deps, task_fn in tasks:
+        started[desc] = Background(_run_task, desc, deps, task_fn)
+    for desc, _, _ in tasks:
+        started[desc].result()
 
 
 def semver_greater_or_equal(installed_ver, required_ver):
@@ -204,44 +317,60 @@ def semver_greater_or_equal(installed_ver, required_ver):
     return split_semver(installed_ver) >= split_semver(required_ver)
 
 
-def install_rust():
+def install_rust(rustup_init):
     rustup_args = "-y --no-modify-path --default-toolchain " + RUST_VER
-    run(
-        "curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- %s" % rustup_args,
-        shell=True,
-    )  # curl invocation taken from https://rustup.rs
+    run("sh %s %s" % (rustup_init, rustup_args))
 
 
-def install_node(args, env_info):
-    node_vers = run("curl -sSL https://nodejs.org/dist/latest-v12.x/", capture=True)
-    node_ver, node_major_ver = re.search(r"node-(v(\d+)\.\d+\.\d+)\.tar.gz", node_vers).groups()
-
-    if env_info.plat == PLAT_DARWIN:
-        if which("brew"):  # This will a.s. be Homebrew.
-            if args.force:
-                run("brew uninstall node", check=False, silent=True)
-            return run("brew install %s node@12" % ("--force" if args.force else ""))
+def node_package_manager(env_info):
+    """Returns the package manager that Node should be installed with, if any."""
+    if env_info.plat != PLAT_DARWIN:
+        return None
+    if which("brew"):  # This will a.s. be Homebrew.
+        return "brew"
+    if which("port"):  # There are no common non-MacPorts tools with this name.
+        return "port"
+    return None
 
-        if which("port"):  # There are no common non-MacPorts tools with this name.
-            return run("port install node%s" % node_major_ver)
 
-    curl = 'curl -L# "%s"' % NODE_DIST_URL.format(plat=env_info.plat, ver=node_ver)
-    tar = 'tar xz -C %s --strip-components=1 --exclude "*.md" --exclude LICENSE' % args.prefix
-    run("{curl} | {tar}".format(curl=curl, tar=tar), shell=True)
+def download_node(env_info, downloader):
+    """Downloads the latest Node 12 distribution. Returns its version and local path."""
+    node_vers = run("curl -sSL https://nodejs.org/dist/latest-v12.x/", capture=True)
+    node_ver = re.search(r"node-(v\d+\.\d+\.\d+)\.tar.gz", node_vers).group(1)
+    node_dist_url = NODE_DIST_URL.format(plat=env_info.plat, ver=node_ver)
+    shasums = run("curl -sSfL %s/SHASUMS256.txt" % osp.dirname(node_dist_url), capture=True)
+    sha256 = re.search(r"([0-9a-f]{64})\s+%s" % re.escape(osp.basename(node_dist_url)), shasums)
+    return node_ver, downloader.download(node_dist_url, sha256.group(1))
+
+
+def install_node(args, env_info, node_ver=None, node_dist=None):
+    node_manager = node_package_manager(env_info)
+    if node_manager == "brew":
+        if args.force:
+            run("brew uninstall node", check=False, silent=True)
+        return run("brew install %s node@12" % ("--force" if args.force else ""))
+    if node_manager == "port":
+        return run("port install node%s" % REQUIRED_NODE_VERSION)
 
+    run(
+        'tar xzf %s -C %s --strip-components=1 --exclude "*.md" --exclude LICENSE'
+        % (node_dist, args.prefix)
+    )
     return node_ver
 
 
-def install_oasis(args, env_info):
-    tools_xml = run("curl -sSL %s" % TOOLS_URL, capture=True)
-    oasis_cli_key = re.search(r"%s/current/oasis-[0-9a-f]{7,}" % env_info.plat, tools_xml).group(0)
+def download_oasis(args, env_info, downloader, oasis_path):
+    """Downloads the Oasis CLI of the `--toolchain` channel and returns its local path."""
+    index = read_index(env_info, args.toolchain)
+    if "oasis" not in index.get("tools", {}):
+        raise RuntimeError("The `%s` toolchain has no Oasis CLI." % args.toolchain)
+    return download_tool(index["tools"]["oasis"], oasis_path, downloader)
 
-    oasis_path = osp.join(args.prefix, "bin", "oasis")
-    if not args.force and osp.exists(oasis_path):
-        raise RuntimeError("`%s` already exists!" % oasis_path)
 
-    s3_url = "%s/%s" % (TOOLS_URL, oasis_cli_key)
-    run("curl -sSLo {path} {url}".format(path=oasis_path, url=s3_url))
+def install_oasis(args, oasis_cli):
+    oasis_path = osp.join(args.prefix, "bin", "oasis")
+    shutil.copyfile(oasis_cli, oasis_path + ".tmp")
+    os.rename(oasis_path + ".tmp", oasis_path)
     run("chmod a+x %s" % oasis_path)
     if args.speedrun:
         oasis_cp = subprocess.Popen(
@@ -254,16 +383,223 @@ def install_oasis(args, env_info):
     run("%s set-toolchain %s" % (oasis_path, args.toolchain), env=_skipconfig_env())
 
 
+def read_index(env_info, channel):
+    """Returns the index of the tools released to `channel`. Channels without an index
+       of their own use the current tools' index, as `oasis set-toolchain` installs them."""
+    index_url = "%s/%s/%s/index.json" % (
+        TOOLS_URL,
+        env_info.plat,
+        CHANNEL_PREFIXES.get(channel, channel),
+    )
+    try:
+        return json.loads(run("curl -sSfL %s" % index_url, capture=True))
+    except subprocess.CalledProcessError:
+        if channel == CURRENT_CHANNEL:
+            raise
+        return read_index(env_info, CURRENT_CHANNEL)
+
+
+def download_tool(tool, path, downloader):
+    """Downloads the `tool` described by its index entry using the smallest applicable
+       payload and returns its local path. Payloads are checked against the binary's
+       published sha256 and, should one fail, the next smallest is tried. A delta applies
+       only to the binary already at `path`."""
+    sha256 = tool.get("sha256")
+    if sha256 and downloader.cached(sha256):
+        return downloader.cached(sha256)
+
+    payload_sizes = {"": tool["size"]}
+    # Only the uncompressed binaries published before checksums were added lack one.
+    if sha256 and XZ_SUFFIX in tool["payloads"] and (lzma or which("xz")):
+        payload_sizes[XZ_SUFFIX] = tool["payloads"][XZ_SUFFIX]["size"]
+    delta = tool["payloads"].get(DELTA_SUFFIX)
+    if sha256 and delta and osp.isfile(path) and which("xdelta3"):
+        if delta["delta_from_sha256"] == file_sha256(path):
+            payload_sizes[DELTA_SUFFIX] = delta["size"]
+
+    def apply_delta(delta_path, out_path):
+        run("xdelta3 -d -f -s %s %s %s" % (path, delta_path, out_path))
+
+    decoders = {"": None, XZ_SUFFIX: decompress_xz, DELTA_SUFFIX: apply_delta}
+    for suffix in sorted(payload_sizes, key=payload_sizes.get):
+        # Payloads published by content may be stored apart from the binary.
+        payload_key = tool["payloads"].get(suffix, {}).get("key") or tool["key"] + suffix
+        try:
+            return downloader.download("%s/%s" % (TOOLS_URL, payload_key), sha256, decoders[suffix])
+        except (OSError, RuntimeError, subprocess.CalledProcessError) as err:
+            print_error("Unable to download `%s`: %s" % (payload_key, err))
+    raise RuntimeError("Unable to download `%s`" % tool["key"])
+
+
+class Downloader(object):  # pylint: disable=useless-object-inheritance
+    """Downloads files into a cache directory where they are named by their sha256.
+       Interrupted downloads are resumed with range requests."""
+
+    def __init__(self, cache_dir, attempts=DOWNLOAD_ATTEMPTS):
+        self.cache_dir = _ensure_dir(cache_dir)
+        self.partial_dir = _ensure_dir(osp.join(cache_dir, "partial"))
+        self.attempts = attempts
+
+    def cached(self, sha256):
+        """Returns the path of the cached file with the `sha256`, if there is one."""
+        path = osp.join(self.cache_dir, sha256)
+        return path if osp.isfile(path) else None
+
+    def download(self, url, sha256=None, decode=None):
+        """Returns the path of the cached file downloaded from `url`, which is checked
+           against `sha256` when it is known. `decode(download_path, out_path)` recovers
+           the file from the download, if the download is, e.g., compressed."""
+        if sha256 and self.cached(sha256):
+            return self.cached(sha256)
+
+        part_path = osp.join(self.partial_dir, hashlib.sha1(url.encode("utf8")).hexdigest())
+        if not sha256 and osp.exists(part_path):
+            os.remove(part_path)  # The content at `url` might have changed since.
+        for attempt in range(self.attempts):
+            try:
+                run("curl -sSfL --tlsv1.2 -C - -o %s %s" % (part_path, url), silent=True)
+                break
+            except subprocess.CalledProcessError as err:
+                if err.returncode == CURL_CANNOT_RESUME and osp.exists(part_path):
+                    os.remove(part_path)
+                if attempt == self.attempts - 1:
+                    raise
+
+        out_path = part_path
+        try:
+            if decode:
+                out_path = part_path + ".out"
+                decode(part_path, out_path)
+            out_sha256 = file_sha256(out_path)
+            if sha256 and out_sha256 != sha256:
+                raise RuntimeError("`%s` does not match its checksum" % url)
+            cache_path = osp.join(self.cache_dir, out_sha256)
+            os.rename(out_path, cache_path)
+            return cache_path
+        finally:
+            for tmp_path in (part_path, out_path):
+                if osp.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+class InstallerState(object):  # pylint: disable=useless-object-inheritance
+    """Remembers what probing the installed tools found, along with the stat data and
+       sha256 of the probed binaries, so that reruns can skip probes of unchanged ones."""
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._probes = {}
+        try:
+            with open(path) as f_state:
+                state = json.load(f_state)
+            if state.get("version") == self.VERSION:
+                self._probes = state["probes"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime, stat.st_ino]
+
+    def probe(self, name, path, probe_fn):
+        """Returns `probe_fn(path)` as found by the last probe of `name`, if it was of the
+           same binary. The binary is the same if its stat data or, failing that, its sha256
+           are unchanged."""
+        with self._lock:
+            probed = self._probes.get(name)
+        if probed is not None and probed["path"] == path:
+            if probed["stat"] == self._stat(path):
+                return probed["result"]
+            sha256 = file_sha256(path)
+            if probed["sha256"] == sha256:
+                self.record(name, path, probed["result"], sha256)
+                return probed["result"]
+        result = probe_fn(path)
+        self.record(name, path, result)
+        return result
+
+    def record(self, name, path, result, sha256=None):
+        """Records that probing the binary `name` at `path` found `result`."""
+        probed = {
+            "path": path,
+            "stat": self._stat(path),
+            "sha256": sha256 or file_sha256(path),
+            "result": result,
+        }
+        with self._lock:
+            self._probes[name] = probed
+
+    def save(self):
+        """Writes the probes' results to the state file."""
+        with self._lock:
+            state = {"version": self.VERSION, "probes": dict(self._probes)}
+        with open(self.path + ".tmp", "w") as f_state:
+            json.dump(state, f_state, indent=2, sort_keys=True)
+        os.rename(self.path + ".tmp", self.path)
+
+
+class Background(threading.Thread):
+    """Calls `fn(*args)` in a thread. `result` waits for and returns (or raises) its result."""
+
+    def __init__(self, fn, *args):
+        super(Background, self).__init__()  # pylint: disable=super-with-arguments
+        self.daemon = True
+        self._call = (fn, args)
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        fn, args = self._call
+        try:
+            self._result = fn(*args)
+        except Exception as err:  # pylint: disable=broad-except
+            self._error = err
+
+    def result(self):
+        """Returns the result of the call once it finishes."""
+        self.join()
+        if self._error is not None:
+            raise self._error  # pylint: disable=raising-bad-type
+        return self._result
+
+
+def decompress_xz(xz_path, out_path):
+    """Decompresses the file at `xz_path` into `out_path`."""
+    if lzma is None:
+        with open(out_path, "wb") as f_out:
+            subprocess.check_call(["xz", "-dc", xz_path], stdout=f_out)
+        return
+    with lzma.open(xz_path) as f_xz, open(out_path, "wb") as f_out:
+        shutil.copyfileobj(f_xz, f_out)
+
+
+def file_sha256(path):
+    """Returns the hex sha256 digest of the file at `path`."""
+    with open(path, "rb") as f_hashed:
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f_hashed.read(2 ** 20), b""):
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
+
 def _skipconfig_env():
     env = dict(os.environ)
     env["OASIS_SKIP_GENERATE_CONFIG"] = "1"
     return env
 
 
-def is_oasis(path):
-    """Returns whether the binary at `path` is the Oasis CLI."""
+def is_oasis(path, state=None):
+    """Returns whether the binary at `path` is the Oasis CLI. The answer is looked up in
+       the `InstallerState`, if one is provided and the binary hasn't changed."""
     if not osp.isfile(path) or osp.isdir(path):
         return False
+    if state is not None:
+        return state.probe("oasis", path, is_oasis)
     try:
         help_msg = run("%s --help" % path, capture=True, env=_skipconfig_env())
         return "Oasis developer tools" in help_msg
@@ -319,26 +655,59 @@ def modify_shell_profile(args, env_info):
 
 
 def run(cmd, capture=False, check=True, silent=False, **call_args):
+    """Runs `cmd`. Within `run_tasks`, its output goes to the running task's log."""
     if not call_args.get("shell", False):
         cmd = shlex.split(cmd)
+    task_log = getattr(_TASK, "log", None)
     # note: the cases below must be expanded to prevent pylint from becoming
     # confused about the return type (string when capture, int otherwise)
     if capture:
-        return subprocess.check_output(cmd, **call_args).decode("utf8").strip()
-    stderr = DEVNULL if silent else None
+        return subprocess.check_output(cmd, stderr=task_log, **call_args).decode("utf8").strip()
+    stderr = task_log or (DEVNULL if silent else None)
     call = subprocess.check_call if check else subprocess.call
-    return call(cmd, stdout=DEVNULL, stderr=stderr, **call_args)
+    return call(cmd, stdout=task_log or DEVNULL, stderr=stderr, **call_args)
 
 
 def which(exe):
-    return run("which %s" % exe, check=False) == 0
+    """Returns the path of the `exe` executable on the PATH, or None."""
+    if os.sep in exe:
+        return exe if osp.isfile(exe) and os.access(exe, os.X_OK) else None
+    for path_dir in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        exe_path = osp.join(path_dir, exe)
+        if osp.isfile(exe_path) and os.access(exe_path, os.X_OK):
+            return exe_path
+    return None
 
 
 def installed_lib(lib):
     """Returns true, if specific library is installed."""
+    if any(osp.exists(osp.join(lib_dir, lib)) for lib_dir in _library_dirs()):
+        return True
+    # The linker might search elsewhere, but asking it is slow.
     return run("ld -l:%s" % lib, check=False, silent=True) == 0
 
 
+def _library_dirs():
+    """Returns the directories searched for shared libraries by the dynamic linker."""
+    lib_dirs = [d for d in os.environ.get("LD_LIBRARY_PATH", "").split(os.pathsep) if d]
+    conf_paths = ["/etc/ld.so.conf"]
+    while conf_paths:
+        conf_path = conf_paths.pop()
+        if not osp.isfile(conf_path):
+            continue
+        with open(conf_path) as f_conf:
+            for line in f_conf:
+                line = line.split("#", 1)[0].strip()
+                if line.startswith("include "):
+                    conf_glob = line.split(None, 1)[1]
+                    if not osp.isabs(conf_glob):
+                        conf_glob = osp.join(osp.dirname(conf_path), conf_glob)
+                    conf_paths.extend(sorted(glob.glob(conf_glob)))
+                elif line:
+                    lib_dirs.append(line)
+    return lib_dirs + ["/lib64", "/usr/lib64", "/lib", "/usr/lib", "/usr/local/lib"]
+
+
 # fmt: off
 # pylint: disable=missing-function-docstring,multiple-statements
 RED, GREEN, YELLOW, BLUE, PINK, PLAIN = list("\033[%sm" % i for i in range(91, 96)) + ["\033[0m"]
@@ -0,0 +1,728 @@
+"""Publishes built tools to the toolstate bucket and reads what's published there."""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import hashlib
+import json
+import lzma
+import os
+import os.path as osp
+import shutil
+import subprocess
+from subprocess import PIPE
+import time
+import urllib.request
+
+from runner import run
+from targets import (
+    BASE_DIR,
+    BIN_BUCKET,
+    get_s3_key,
+    HOST_TARGET,
+    INDEX_NAME,
+    parse_s3_key,
+    TOOLS_DIR,
+)
+from tracing import TRACER
+
+__all__ = [
+    "MANIFEST_VERSION",
+    "S3Transfers",
+    "Publisher",
+    "write_index",
+    "index_entry",
+    "read_index",
+    "collect_garbage",
+    "find_unchanged",
+    "make_payloads",
+    "file_sha256",
+    "get_versions",
+    "read_manifest",
+    "read_public_manifest",
+    "write_manifest",
+    "get_current_versions",
+    "get_s3_client",
+]
+
+# boto3 and botocore are imported where they're used, since importing them takes longer
+# than a run that finds nothing to update.
+
+ARTIFACTS_DIR = osp.join(TOOLS_DIR, "artifacts")
+# The bucket is publicly readable, so manifests can be read before getting an S3 client.
+BIN_BUCKET_URL = os.environ.get(
+    "TOOLSTATE_BUCKET_URL", f"https://s3-us-west-2.amazonaws.com/{BIN_BUCKET}"
+)
+MANIFEST_TIMEOUT = 10  # seconds
+MANIFEST_VERSION = 1
+# Each tool binary is published with alternative payloads: xz-compressed, and optionally
+# as an xdelta3 patch of the previous current version. All of them have the binary's
+# sha256 in their metadata.
+XZ_SUFFIX = ".xz"
+DELTA_SUFFIX = ".xd3"
+PAYLOAD_SUFFIXES = (XZ_SUFFIX, DELTA_SUFFIX)
+INDEX_VERSION = 1
+# Objects are kept this long after they leave the index, since installers that read the
+# previous index may still be downloading them, and objects that no entry refers to are kept
+# this long after upload, since a concurrent run may be about to publish them.
+GC_GRACE = timedelta(days=1)
+GC_BATCH_SIZE = 1000  # the most keys that `DeleteObjects` takes
+S3_CREDS_SCRIPT = osp.join(BASE_DIR, ".github", "workflows", "get-s3-creds.sh")
+S3_CREDS_TTL = 3600  # seconds, as issued by Vault's AWS secrets engine
+
+
+class S3Transfers:
+    """Runs S3 uploads and server-side copies in the toolstate bucket concurrently.
+       Files larger than `part_size` bytes are uploaded in parts, `concurrency` at a time."""
+
+    def __init__(self, s3, part_size=16 * 2 ** 20, concurrency=8):
+        self.s3 = s3
+        self.concurrency = concurrency
+        from boto3.s3.transfer import TransferConfig  # pylint: disable=import-outside-toplevel
+
+        self.transfer_config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=concurrency,
+        )
+
+    def upload_files(self, path_keys, metadata=None):
+        """Uploads the files in `{ <path>: <key> }`, with `{ <key>: <metadata> }`."""
+        metadata = metadata or {}
+        self._map(
+            lambda path_key: self._upload_file(*path_key, metadata.get(path_key[1], {})),
+            path_keys.items(),
+        )
+
+    def _upload_file(self, path, key, metadata):
+        with TRACER.span(f"upload {key}", "s3", bytes_out=osp.getsize(path)):
+            self.s3.upload_file(
+                path,
+                BIN_BUCKET,
+                key,
+                ExtraArgs={"Metadata": metadata},
+                Config=self.transfer_config,
+            )
+
+    def copy_objects(self, src_dst_keys):
+        """Copies the objects in `{ <src key>: <dst key> }` without downloading them."""
+        self._map(
+            lambda src_dst_key: self.s3.copy_object(
+                Bucket=BIN_BUCKET,
+                Key=src_dst_key[1],
+                CopySource={"Bucket": BIN_BUCKET, "Key": src_dst_key[0]},
+            ),
+            src_dst_keys.items(),
+        )
+
+    def _map(self, func, items):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(func, items))
+
+
+class Publisher:
+    """Publishes the tools built for a `target` to the toolstate bucket using `transfers`.
+       Each binary is uploaded along with its `PAYLOAD_SUFFIXES` payloads. Deltas are made
+       against the current version, if `deltas` is set and `xdelta3` is installed."""
+
+    def __init__(self, transfers, target=HOST_TARGET, deltas=False):
+        self.s3 = transfers.s3
+        self.transfers = transfers
+        self.target = target
+        self.deltas = deltas
+
+    def built_tools(self):
+        """Returns the names of the tools built for the target."""
+        if not osp.isdir(self.target.bin_dir):
+            return set()
+        return {de.name for de in os.scandir(self.target.bin_dir)}
+
+    def make_payloads(self, tools, base_key):
+        """Returns the `make_payloads` of each of `tools`, with deltas from `base_key(tool)`."""
+        with ThreadPoolExecutor() as pool:
+            return dict(
+                zip(
+                    tools,
+                    pool.map(
+                        lambda tool: make_payloads(
+                            tool, self.target, base_key(tool), self.s3 if self.deltas else None
+                        ),
+                        tools,
+                    ),
+                )
+            )
+
+    def sync_tools(self, head_versions, cached_versions, update_current, current_versions=None):
+        """Uploads built artifacts to the s3 under the current-but-not-released prefex.
+           Removes any outdated artifacts and records the new versions in the manifest.
+           Binaries identical to their cached or current version are copied within the
+           bucket rather than uploaded."""
+        s3, target = self.s3, self.target
+        if current_versions is None:
+            current_versions = get_current_versions(s3, target)
+        built_tools = self.built_tools()
+
+        unchanged = self._find_unchanged(built_tools, cached_versions, current_versions)
+        tool_payloads = self.make_payloads(
+            built_tools - set(unchanged),
+            lambda tool: current_versions.get(tool)
+            and get_s3_key(target.cd_pfx, tool, current_versions[tool]),
+        )
+        if unchanged:
+            print(f"unchanged for {target.name}: {' '.join(sorted(unchanged))}")
+        tool_sizes = self._upload_to_cache(head_versions, tool_payloads, unchanged)
+        to_delete = [
+            key
+            for tool in built_tools
+            if cached_versions.get(tool)
+            for key in _with_payloads(get_s3_key(target.cache_pfx, tool, cached_versions[tool]))
+        ]
+
+        if update_current:
+            to_delete.extend(
+                key
+                for tool, ver in current_versions.items()
+                if head_versions.get(tool) != ver
+                for key in _with_payloads(get_s3_key(target.cd_pfx, tool, ver))
+            )
+            # The built tools were just uploaded to the cache, so they're copied like the
+            # others. Tools built by earlier runs are published without the payloads they
+            # may lack.
+            self.transfers.copy_objects(
+                {
+                    get_s3_key(target.cache_pfx, tool, ver)
+                    + suffix: get_s3_key(target.cd_pfx, tool, ver)
+                    + suffix
+                    for tool, ver in head_versions.items()
+                    if current_versions.get(tool) != ver
+                    for suffix in tool_sizes.get(tool, {"": None})
+                }
+            )
+            # The index is written once everything it lists exists and before anything it
+            # used to list is deleted, so that installers never see missing artifacts.
+            write_index(s3, target, head_versions, tool_sizes)
+
+        if to_delete:
+            s3.delete_objects(
+                Bucket=BIN_BUCKET, Delete={"Objects": [{"Key": k} for k in to_delete]}
+            )
+
+        cached_versions = {**cached_versions, **{tool: head_versions[tool] for tool in built_tools}}
+        write_manifest(
+            s3, target, cached_versions, head_versions if update_current else current_versions
+        )
+
+    def _find_unchanged(self, tools, cached_versions, current_versions):
+        """Returns `{ <tool>: (<key>, <payloads>) }` of the `tools` whose binaries are
+           identical to their cached or current version, per `find_unchanged`."""
+        target = self.target
+
+        def _prev_keys(tool):
+            prev_keys = []
+            if cached_versions.get(tool):
+                prev_keys.append(get_s3_key(target.cache_pfx, tool, cached_versions[tool]))
+            if current_versions.get(tool):
+                prev_keys.append(get_s3_key(target.cd_pfx, tool, current_versions[tool]))
+            return prev_keys
+
+        with ThreadPoolExecutor() as pool:
+            return {
+                tool: prev_key_payloads
+                for tool, prev_key_payloads in zip(
+                    tools,
+                    pool.map(
+                        lambda tool: find_unchanged(self.s3, tool, target, _prev_keys(tool)), tools,
+                    ),
+                )
+                if prev_key_payloads
+            }
+
+    def _upload_to_cache(self, head_versions, tool_payloads, unchanged):
+        """Uploads the `tool_payloads` of the changed tools and copies the `unchanged` ones
+           to the cache prefix. Returns `{ <tool>: { <key suffix>: (<size>, <metadata>) } }`
+           of all the built tools."""
+        target = self.target
+        upload_keys = {}
+        upload_metadata = {}
+        for tool, payloads in tool_payloads.items():
+            cache_key = get_s3_key(target.cache_pfx, tool, head_versions[tool])
+            for suffix, (path, metadata) in payloads.items():
+                upload_keys[path] = cache_key + suffix
+                upload_metadata[cache_key + suffix] = metadata
+        self.transfers.upload_files(upload_keys, upload_metadata)
+        self.transfers.copy_objects(
+            {
+                prev_key + suffix: get_s3_key(target.cache_pfx, tool, head_versions[tool]) + suffix
+                for tool, (prev_key, payloads) in unchanged.items()
+                for suffix in payloads
+            }
+        )
+        tool_sizes = {
+            tool: {
+                suffix: (osp.getsize(path), metadata)
+                for suffix, (path, metadata) in payloads.items()
+            }
+            for tool, payloads in tool_payloads.items()
+        }
+        tool_sizes.update((tool, payloads) for tool, (_, payloads) in unchanged.items())
+        return tool_sizes
+
+    def publish_tools(self, head_versions, update_current):
+        """Publishes the built tools so that readers never see a half-updated set. Payloads
+           are uploaded in parallel under immutable keys in `target.objects_pfx`, named by
+           their content. The index, which readers resolve tools with, then flips to them
+           in a single write that fails if the index changed since it was read. The
+           manifest follows, recording each version's index entry for later runs, and when
+           the entries that are no longer live were retired. The objects of those retired
+           for longer than `GC_GRACE` are then deleted by `collect_garbage`, which returns
+           them."""
+        manifest, entries, index_etag = self._read_entries()
+        built_tools = self.built_tools()
+
+        unchanged = self._reuse_published(built_tools, head_versions, entries)
+        if unchanged:
+            print(f"unchanged for {self.target.name}: {' '.join(sorted(unchanged))}")
+
+        def _prev_key(tool):
+            prev_entry = entries.get(f"{tool}-{manifest['current'].get(tool)}")
+            return prev_entry["key"] if prev_entry else None
+
+        self._upload_objects(
+            head_versions, self.make_payloads(built_tools - unchanged, _prev_key), entries
+        )
+
+        cached_versions = {
+            **manifest["cache"],
+            **{tool: head_versions[tool] for tool in built_tools},
+        }
+        current_versions = head_versions if update_current else manifest["current"]
+        live_entries = self._live_entries(
+            list(cached_versions.items()) + list(current_versions.items()), entries
+        )
+        if update_current:
+            self._flip_index(
+                {tool: live_entries[f"{tool}-{ver}"] for tool, ver in current_versions.items()},
+                index_etag,
+            )
+        retired_entries, expired_entries = _retire_entries(entries, live_entries)
+        write_manifest(
+            self.s3,
+            self.target,
+            cached_versions,
+            current_versions,
+            {**live_entries, **retired_entries},
+        )
+
+        return collect_garbage(
+            self.s3,
+            self.target,
+            _entry_keys(expired_entries.values()),
+            _entry_keys(list(live_entries.values()) + list(retired_entries.values())),
+        )
+
+    def _read_entries(self):
+        """Returns the manifest, the index entries of the versions that the manifest and the
+           index know of, and the index's ETag."""
+        manifest = read_manifest(self.s3, self.target) or {"cache": {}, "current": {}}
+        entries = manifest.get("entries", {})
+        index, index_etag = _get_json(self.s3, self.target.index_key)
+        if index.get("version") == INDEX_VERSION:
+            for tool, entry in index["tools"].items():
+                entries.setdefault(f"{tool}-{entry['rev']}", entry)
+        return manifest, entries, index_etag
+
+    def _reuse_published(self, tools, head_versions, entries):
+        """Adds `entries` for the `tools` whose binaries are already published, e.g. when
+           only docs changed, and returns those tools."""
+        published = {
+            entry["sha256"]: entry
+            for entry in entries.values()
+            if entry["key"].startswith(self.target.objects_pfx)
+        }
+        unchanged = set()
+        with ThreadPoolExecutor() as pool:
+            for tool, sha256 in zip(
+                tools,
+                pool.map(lambda tool: file_sha256(osp.join(self.target.bin_dir, tool)), tools),
+            ):
+                if sha256 in published:
+                    entries[f"{tool}-{head_versions[tool]}"] = {
+                        **published[sha256],
+                        "rev": head_versions[tool],
+                    }
+                    unchanged.add(tool)
+        return unchanged
+
+    def _upload_objects(self, head_versions, tool_payloads, entries):
+        """Uploads the `tool_payloads` under keys named by their content and adds their
+           `entries`."""
+        upload_keys = {}
+        upload_metadata = {}
+        for tool, payloads in tool_payloads.items():
+            key = self.target.objects_pfx + payloads[""][1]["sha256"]
+            payload_keys = {"": key}
+            for suffix, (path, metadata) in payloads.items():
+                if suffix == DELTA_SUFFIX:  # a delta depends on its base, too
+                    payload_keys[suffix] = f"{key}-{metadata['delta-from-sha256']}{suffix}"
+                else:
+                    payload_keys[suffix] = key + suffix
+                upload_keys[path] = payload_keys[suffix]
+                upload_metadata[payload_keys[suffix]] = metadata
+            entries[f"{tool}-{head_versions[tool]}"] = index_entry(
+                head_versions[tool],
+                key,
+                {suffix: (osp.getsize(path), md) for suffix, (path, md) in payloads.items()},
+                {suffix: k for suffix, k in payload_keys.items() if suffix == DELTA_SUFFIX},
+            )
+        self.transfers.upload_files(upload_keys, upload_metadata)
+
+    def _live_entries(self, live_versions, entries):
+        """Returns the `entries` of the `(<tool>, <version>)`s in `live_versions`, describing
+           the objects of those that have none, which were published by `sync_tools`."""
+        for tool, ver in live_versions:
+            if f"{tool}-{ver}" not in entries:
+                key = get_s3_key(self.target.cache_pfx, tool, ver)
+                entries[f"{tool}-{ver}"] = index_entry(ver, key, _describe_payloads(self.s3, key))
+        # Entries that were retired, or copied from one by `_reuse_published`, are live again.
+        return {
+            f"{tool}-{ver}": {
+                field: val
+                for field, val in entries[f"{tool}-{ver}"].items()
+                if field != "retired_at"
+            }
+            for tool, ver in live_versions
+        }
+
+    def _flip_index(self, index_tools, index_etag):
+        """Writes the index of `index_tools` if it still has `index_etag`."""
+        try:
+            _put_json(
+                self.s3,
+                self.target.index_key,
+                {"version": INDEX_VERSION, "tools": index_tools},
+                etag=index_etag,
+            )
+        except self.s3.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] not in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                raise
+            raise RuntimeError(
+                f"{self.target.index_key} was published by another run in the meantime"
+            ) from err
+
+
+def write_index(s3, target, current_versions, tool_payloads):
+    """Writes the index of the current tools that `installer.py` resolves releases with.
+       `tool_payloads` describes the payloads of the tools built by this run as
+       `{ <tool>: { <key suffix>: (<size>, <metadata>) } }`. The other tools are carried
+       over from the previous index or, failing that, described by their objects."""
+    prev_tools = read_index(s3, target).get("tools", {})
+
+    def _index_entry(tool, ver):
+        if tool not in tool_payloads and prev_tools.get(tool, {}).get("rev") == ver:
+            return prev_tools[tool]
+        key = get_s3_key(target.cd_pfx, tool, ver)
+        return index_entry(ver, key, tool_payloads.get(tool) or _describe_payloads(s3, key))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        entries = pool.map(lambda tool_ver: _index_entry(*tool_ver), current_versions.items())
+        index = {"version": INDEX_VERSION, "tools": dict(zip(current_versions, entries))}
+    _put_json(s3, target.index_key, index)
+
+
+def index_entry(ver, key, payloads, payload_keys=None):
+    """Returns the index entry of the tool at `ver` stored at `key`, whose payloads are
+       `{ <key suffix>: (<size>, <metadata>) }`. Payloads not stored at `key` + suffix
+       are given by `payload_keys`, as `{ <key suffix>: <key> }`."""
+    payloads = dict(payloads)
+    size, metadata = payloads.pop("")
+    entry = {"rev": ver, "key": key, "size": size, "sha256": metadata.get("sha256")}
+    entry["payloads"] = {suffix: {"size": size} for suffix, (size, _) in payloads.items()}
+    for suffix, payload_key in (payload_keys or {}).items():
+        entry["payloads"][suffix]["key"] = payload_key
+    if DELTA_SUFFIX in payloads:
+        entry["payloads"][DELTA_SUFFIX]["delta_from_sha256"] = payloads[DELTA_SUFFIX][1][
+            "delta-from-sha256"
+        ]
+    return entry
+
+
+def read_index(s3, target=HOST_TARGET):
+    """Returns the index of the current tools last written by `write_index`, or `{}`."""
+    index = _get_json(s3, target.index_key)[0]
+    return index if index.get("version") == INDEX_VERSION else {}
+
+
+def _retire_entries(entries, live_entries, grace=GC_GRACE):
+    """Returns the `entries` that aren't in `live_entries`, marked with when they were first
+       found not to be, split into those retired within `grace` and those retired before."""
+    now = datetime.now(timezone.utc)
+    retired_entries = {
+        name: {"retired_at": now.isoformat(timespec="seconds"), **entry}
+        for name, entry in entries.items()
+        if name not in live_entries
+    }
+    expired_names = {
+        name
+        for name, entry in retired_entries.items()
+        if datetime.fromisoformat(entry["retired_at"]) < now - grace
+    }
+    return (
+        {name: entry for name, entry in retired_entries.items() if name not in expired_names},
+        {name: retired_entries[name] for name in expired_names},
+    )
+
+
+def _entry_keys(entries):
+    """Returns the keys of the objects of the index `entries`, including their payloads."""
+    return {
+        payload.get("key", entry["key"] + suffix)
+        for entry in entries
+        for suffix, payload in [("", {})] + list(entry["payloads"].items())
+    }
+
+
+def collect_garbage(s3, target, expired_keys, kept_keys, grace=GC_GRACE):
+    """Deletes the `expired_keys` that aren't in `kept_keys`, along with the objects in
+       `target.objects_pfx` that neither refers to and that are older than `grace`, such as
+       those uploaded by a run that failed before it flipped the index. Deletes in batches."""
+    with TRACER.span(f"collect_garbage {target.name}", "s3") as span_args:
+        cutoff = datetime.now(timezone.utc) - grace
+        pages = s3.get_paginator("list_objects_v2").paginate(
+            Bucket=BIN_BUCKET, Prefix=target.objects_pfx
+        )
+        garbage = sorted(
+            {key for key in expired_keys if key not in kept_keys}
+            | {
+                obj["Key"]
+                for page in pages
+                for obj in page.get("Contents", [])
+                if obj["Key"] not in kept_keys and obj["LastModified"] < cutoff
+            }
+        )
+        for i in range(0, len(garbage), GC_BATCH_SIZE):
+            s3.delete_objects(
+                Bucket=BIN_BUCKET,
+                Delete={
+                    "Objects": [{"Key": key} for key in garbage[i : i + GC_BATCH_SIZE]],
+                    "Quiet": True,
+                },
+            )
+        span_args["deleted"] = len(garbage)
+    return garbage
+
+
+def _get_json(s3, key):
+    """Returns the JSON object at `key` and its ETag, or `({}, None)` if there is none."""
+    try:
+        obj = s3.get_object(Bucket=BIN_BUCKET, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return {}, None
+    return json.load(obj["Body"]), obj.get("ETag")
+
+
+def _put_json(s3, key, json_obj, etag=False):
+    """Writes `json_obj` to `key`. If an `etag` is given, the write succeeds only if
+       the object still has it or, if it's None, only if there is no object."""
+    conditions = {}
+    if etag is not False:
+        conditions = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    s3.put_object(
+        Bucket=BIN_BUCKET,
+        Key=key,
+        Body=json.dumps(json_obj, indent=2, sort_keys=True).encode(),
+        ContentType="application/json",
+        **conditions,
+    )
+
+
+def _describe_payloads(s3, key):
+    """Returns the payloads at `key` as `{ <key suffix>: (<size>, <metadata>) }`."""
+    payloads = {}
+    for suffix in ("",) + PAYLOAD_SUFFIXES:
+        try:
+            obj = s3.head_object(Bucket=BIN_BUCKET, Key=key + suffix)
+        except s3.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] != "404":
+                raise
+            continue
+        payloads[suffix] = (obj["ContentLength"], obj["Metadata"])
+    return payloads
+
+
+def find_unchanged(s3, tool, target, prev_keys):
+    """Returns the first of `prev_keys` whose binary is identical to the `tool` built for
+       `target`, as compared by the sha256 in its metadata, along with its payloads as
+       `{ <key suffix>: (<size>, <metadata>) }`. Returns None if there is no such key."""
+    sha256 = None
+    for prev_key in prev_keys:
+        payloads = _describe_payloads(s3, prev_key)
+        if "" not in payloads:
+            continue
+        sha256 = sha256 or file_sha256(osp.join(target.bin_dir, tool))
+        if payloads[""][1].get("sha256") == sha256:
+            return prev_key, payloads
+    return None
+
+
+def make_payloads(tool, target=HOST_TARGET, prev_key=None, s3=None):
+    """Returns the payloads of the `tool` built for `target` as
+       `{ <key suffix>: (<path>, <metadata>) }`. A delta is made against the current
+       binary at `prev_key` if `s3` is provided to fetch it."""
+    bin_path = osp.join(target.bin_dir, tool)
+    metadata = {"sha256": file_sha256(bin_path)}
+    payloads = {"": (bin_path, metadata)}
+
+    artifacts_dir = osp.join(ARTIFACTS_DIR, target.name)
+    os.makedirs(artifacts_dir, exist_ok=True)
+    xz_path = osp.join(artifacts_dir, tool + XZ_SUFFIX)
+    with open(bin_path, "rb") as f_bin, lzma.open(xz_path, "wb") as f_xz:
+        shutil.copyfileobj(f_bin, f_xz)
+    payloads[XZ_SUFFIX] = (xz_path, metadata)
+
+    xdelta3 = shutil.which("xdelta3")
+    if s3 is not None and prev_key is not None and xdelta3:
+        prev_path = osp.join(artifacts_dir, f"{tool}-prev")
+        delta_path = osp.join(artifacts_dir, tool + DELTA_SUFFIX)
+        s3.download_file(BIN_BUCKET, prev_key, prev_path)
+        run(f"{xdelta3} -e -f -9 -s {prev_path} {bin_path} {delta_path}")
+        delta_metadata = {**metadata, "delta-from-sha256": file_sha256(prev_path)}
+        payloads[DELTA_SUFFIX] = (delta_path, delta_metadata)
+    return payloads
+
+
+def _with_payloads(key):
+    return [key] + [key + suffix for suffix in PAYLOAD_SUFFIXES]
+
+
+def file_sha256(path):
+    """Returns the hex sha256 digest of the file at `path`."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f_hashed:
+        for chunk in iter(lambda: f_hashed.read(2 ** 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_versions(s3, target=HOST_TARGET, use_manifest=True):
+    """Returns the cached and current tools of `target` as `{ <tool name>: <version> }`s.
+       They are read from the manifest, if it exists, or else by listing the bucket."""
+    manifest = read_manifest(s3, target) if use_manifest else None
+    if manifest is not None:
+        return manifest["cache"], manifest["current"]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        cached_versions, current_versions = pool.map(
+            lambda prefix: _get_tools_in(s3, prefix), [target.cache_pfx, target.cd_pfx]
+        )
+    return cached_versions, current_versions
+
+
+def read_manifest(s3, target=HOST_TARGET):
+    """Returns the manifest of tool versions last written by `Publisher.sync_tools`, if any."""
+    try:
+        manifest_obj = s3.get_object(Bucket=BIN_BUCKET, Key=target.manifest_key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    manifest = json.load(manifest_obj["Body"])
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def read_public_manifest(target=HOST_TARGET):
+    """Returns the manifest of `target` like `read_manifest`, but read anonymously over
+       HTTP, which needs no S3 client. Returns None if it can't be read."""
+    try:
+        with urllib.request.urlopen(
+            f"{BIN_BUCKET_URL}/{target.manifest_key}", timeout=MANIFEST_TIMEOUT
+        ) as manifest_resp:
+            manifest = json.load(manifest_resp)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+
+def write_manifest(s3, target, cached_versions, current_versions, entries=None):
+    """Records the versions of the tools in the bucket so that they needn't be listed,
+       along with the index `entries` of those published by `Publisher.publish_tools`,
+       including the retired ones that haven't been collected yet."""
+    manifest = {"version": MANIFEST_VERSION, "cache": cached_versions, "current": current_versions}
+    if entries is not None:
+        manifest["entries"] = entries
+    _put_json(s3, target.manifest_key, manifest)
+
+
+def get_current_versions(s3, target=HOST_TARGET):
+    """Returns the current tools of `target` as `{ <tool name>: <version> }`."""
+    return _get_tools_in(s3, target.cd_pfx)
+
+
+def _get_tools_in(s3, prefix):
+    """Returns the `{ <tool name>: <version> }`s in the bucket under `prefix`."""
+    pages = s3.get_paginator("list_objects_v2").paginate(Bucket=BIN_BUCKET, Prefix=prefix)
+    return dict(
+        parse_s3_key(obj["Key"])
+        for page in pages
+        for obj in page.get("Contents", [])
+        if not obj["Key"].endswith(PAYLOAD_SUFFIXES) and obj["Key"] != prefix + INDEX_NAME
+    )
+
+
+@lru_cache(maxsize=None)
+def get_s3_client(max_pool_connections=10):
+    """Returns a boto s3 client that has permissions to modify the toolstate bucket.
+       The client is shared by the whole run and renews its credentials before they expire."""
+    # pylint: disable=import-outside-toplevel
+    import boto3
+    import botocore.config
+    import botocore.credentials
+    import botocore.session
+
+    class VaultCredentialProvider(botocore.credentials.CredentialProvider):
+        """Provides the credentials issued by `S3_CREDS_SCRIPT`."""
+
+        METHOD = "vault"
+
+        def load(self):
+            return botocore.credentials.RefreshableCredentials.create_from_metadata(
+                metadata=_fetch_vault_creds(), refresh_using=_fetch_vault_creds, method=self.METHOD
+            )
+
+    session = botocore.session.get_session()
+    session.get_component("credential_provider").insert_before("env", VaultCredentialProvider())
+    s3 = boto3.Session(botocore_session=session).client(
+        "s3", config=botocore.config.Config(max_pool_connections=max_pool_connections)
+    )
+    s3.meta.events.register("before-call.s3", _trace_s3_call_start)
+    s3.meta.events.register("after-call.s3", _trace_s3_call_end)
+    return s3
+
+
+def _trace_s3_call_start(context, **_):
+    context["trace_start"] = time.perf_counter()
+
+
+def _trace_s3_call_end(http_response, model, context, **_):
+    TRACER.add_span(
+        f"s3 {model.name}",
+        "s3",
+        context["trace_start"],
+        status=http_response.status_code,
+        bytes_in=int(http_response.headers.get("content-length", 0)),
+    )
+
+
+def _fetch_vault_creds():
+    # Run directly so that the credentials can't be recorded by the `RUNNER`.
+    access_key, secret_key, token = subprocess.run(
+        S3_CREDS_SCRIPT, stdout=PIPE, check=True, encoding="utf8"
+    ).stdout.split("\t")
+    expiry_time = datetime.now(timezone.utc) + timedelta(seconds=S3_CREDS_TTL)
+    return {
+        "access_key": access_key,
+        "secret_key": secret_key,
+        "token": token,
+        "expiry_time": expiry_time.isoformat(),
+    }
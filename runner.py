@@ -0,0 +1,213 @@
+"""Runs the commands of update_toolstate.py with a pluggable backend."""
+
+import asyncio
+from collections import defaultdict, deque
+import json
+import os
+import re
+import shlex
+import subprocess
+from subprocess import PIPE
+import threading
+
+from targets import HOST_TARGET
+from tracing import TRACER
+
+__all__ = [
+    "run",
+    "Runner",
+    "AsyncBackend",
+    "DryRunBackend",
+    "RecordingBackend",
+    "ReplayBackend",
+    "RUNNER",
+]
+
+# Commands that use any of these need a shell. The others are executed directly.
+SHELL_SYNTAX = re.compile(r"[|&;<>()$`\\*?\[\]{}~#\n]|^\s*\w+=")
+CAPTURE_LIMIT = 2 ** 28  # bytes of a command's output that are kept in memory
+
+
+def run(cmd, envs=None, check=True, **run_args):
+    print(f"+ {cmd}")
+    with TRACER.span(cmd, "run"):
+        return RUNNER.run(cmd, envs, check, **run_args)
+
+
+class Runner:
+    """Runs the commands of the whole process with a pluggable `backend`, whose `execute`
+       coroutine takes the arguments of `subprocess.run` and returns a `CompletedProcess`.
+       The backend runs on an event loop in a background thread, so that blocking callers
+       and coroutines awaiting `run_async` can share it. Commands are run in the env of
+       the process, computed once, with the built tools first on the PATH."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or AsyncBackend()
+        self.env = None
+        self.refresh_env()
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def refresh_env(self):
+        """Recomputes the env of the commands, should `os.environ` have changed."""
+        self.env = {**os.environ, "PATH": f"{HOST_TARGET.bin_dir}:{os.environ['PATH']}"}
+
+    def run(self, cmd, envs=None, check=True, **run_args):
+        """Runs `cmd` like `subprocess.run` in text mode and waits for it. Must not be
+           called from coroutines on the runner's loop, which should use `run_async`."""
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_async(cmd, envs, check, **run_args), self._get_loop()
+        )
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()  # e.g. on a KeyboardInterrupt, which kills the command
+            raise
+
+    async def run_async(self, cmd, envs=None, check=True, **run_args):
+        """Runs `cmd` like `run`. The command is killed if the coroutine is cancelled."""
+        env = {**self.env, **envs} if envs else self.env
+        result = await self.backend.execute(cmd, env=env, **run_args)
+        if check:
+            result.check_returncode()
+        return result
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="runner", daemon=True).start()
+        return self._loop
+
+
+class AsyncBackend:
+    """Executes commands as asyncio subprocesses, without a shell unless they need one.
+       Their piped output is read as it's produced, up to `CAPTURE_LIMIT` bytes each."""
+
+    executes = True  # whether commands have effects, such as built binaries
+
+    async def execute(
+        self, cmd, env, cwd=None, input=None, timeout=None, **pipes
+    ):  # pylint: disable=redefined-builtin
+        """Executes `cmd` and returns its `subprocess.CompletedProcess`. The `pipes` are its
+           `stdout` and `stderr`, as for `subprocess.run`."""
+        stdio = {
+            "stdin": PIPE if input is not None else None,
+            "stdout": pipes.get("stdout"),
+            "stderr": pipes.get("stderr"),
+            "cwd": cwd,
+            "env": env,
+        }
+        if SHELL_SYNTAX.search(cmd):
+            proc = await asyncio.create_subprocess_shell(cmd, **stdio)
+        else:
+            proc = await asyncio.create_subprocess_exec(*shlex.split(cmd), **stdio)
+        try:
+            _, out, err, returncode = await asyncio.wait_for(
+                asyncio.gather(
+                    self._write(proc.stdin, input),
+                    self._read(cmd, proc.stdout),
+                    self._read(cmd, proc.stderr),
+                    proc.wait(),
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(cmd, timeout) from None
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        return subprocess.CompletedProcess(cmd, returncode, out, err)
+
+    @staticmethod
+    async def _write(stream, text):
+        if stream is None:
+            return
+        # Like `subprocess.run`, ignore commands that exit without reading their input.
+        try:
+            stream.write(text.encode())
+            await stream.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        stream.close()
+
+    @staticmethod
+    async def _read(cmd, stream):
+        if stream is None:
+            return None
+        chunks, size = [], 0
+        while chunk := await stream.read(2 ** 16):
+            size += len(chunk)
+            if size > CAPTURE_LIMIT:
+                raise RuntimeError(f"`{cmd}` output more than {CAPTURE_LIMIT} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks).decode("utf8")
+
+
+class DryRunBackend:
+    """Pretends that commands succeed without output, so that a run can be profiled
+       without building anything."""
+
+    executes = False
+
+    async def execute(self, cmd, env, stdout=None, stderr=None, **_):
+        """Returns a successful `subprocess.CompletedProcess` of `cmd`."""
+        del env  # unused
+        return subprocess.CompletedProcess(
+            cmd, 0, "" if stdout == PIPE else None, "" if stderr == PIPE else None
+        )
+
+
+class RecordingBackend:
+    """Executes commands with another `backend` and appends their results to the JSON
+       lines file at `path`, which a `ReplayBackend` can replay."""
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.executes = backend.executes
+        self.path = path
+        self._lock = threading.Lock()
+
+    async def execute(self, cmd, env, cwd=None, **run_args):
+        """Executes `cmd` and records its `subprocess.CompletedProcess`."""
+        result = await self.backend.execute(cmd, env, cwd=cwd, **run_args)
+        record = {
+            "cmd": cmd,
+            "cwd": cwd and str(cwd),
+            "returncode": result.returncode,
+            "stdout": result.stdout,
+            "stderr": result.stderr,
+        }
+        with self._lock, open(self.path, "a") as f_record:
+            f_record.write(json.dumps(record) + "\n")
+        return result
+
+
+class ReplayBackend:
+    """Returns the results recorded by a `RecordingBackend` in the file at `path` instead
+       of executing commands. A command run more than once gets its results in order."""
+
+    executes = False
+
+    def __init__(self, path):
+        self._results = defaultdict(deque)  # (cmd, cwd): CompletedProcess
+        with open(path) as f_record:
+            for line in f_record:
+                record = json.loads(line)
+                self._results[(record["cmd"], record["cwd"])].append(
+                    subprocess.CompletedProcess(
+                        record["cmd"], record["returncode"], record["stdout"], record["stderr"]
+                    )
+                )
+
+    async def execute(self, cmd, env, cwd=None, **_):
+        """Returns the next recorded `subprocess.CompletedProcess` of `cmd` in `cwd`."""
+        del env  # unused
+        try:
+            return self._results[(cmd, cwd and str(cwd))].popleft()
+        except IndexError:
+            raise RuntimeError(f"no recorded result of `{cmd}` in {cwd}") from None
+
+
+RUNNER = Runner()
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+"""Benchmarks parts of update_toolstate.py and installer.py against local stand-ins:
+bare git repos behind a latency shim, an in-memory S3 bucket, stub builders and a local
+HTTP server. Nothing here touches the network, so it can be run on any Linux box with git."""
+
+import argparse
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import math
+import os
+import os.path as osp
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import botocore.exceptions
+import yaml
+
+# update_toolstate keeps its checkouts and caches in the tools dir, which is redirected
+# to a scratch dir before it's imported.
+_TMP_DIR = tempfile.TemporaryDirectory(prefix="toolstate-bench-")
+os.environ["TOOLSTATE_TOOLS_DIR"] = osp.join(_TMP_DIR.name, "tools")
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+import builds  # pylint: disable=wrong-import-position
+import installer  # pylint: disable=wrong-import-position
+import publishing  # pylint: disable=wrong-import-position
+import runner  # pylint: disable=wrong-import-position
+import update_toolstate  # pylint: disable=wrong-import-position
+
+GIT = shutil.which("git")
+
+
+def main():
+    args = _parse_args()
+    with _TMP_DIR as tmp_dir:
+        args.func(args, tmp_dir)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    ls_remote = subparsers.add_parser("ls-remote", help="Time get_head_versions.")
+    ls_remote.add_argument("--repos", type=int, default=4, help="Number of tool repos.")
+    ls_remote.add_argument(
+        "--latency", type=float, default=0.3, help="Seconds added to each `git ls-remote`."
+    )
+    ls_remote.set_defaults(func=bench_ls_remote)
+
+    clone = subparsers.add_parser("clone", help="Time SourceFetcher clone strategies.")
+    clone.add_argument("--commits", type=int, default=5000, help="Length of the history.")
+    clone.add_argument(
+        "--file-size", type=int, default=16384, help="Bytes rewritten by each commit."
+    )
+    clone.set_defaults(func=bench_clone)
+
+    s3_client = subparsers.add_parser("s3-client", help="Time S3 client setup.")
+    s3_client.add_argument(
+        "--uses", type=int, default=2, help="Number of times a run needs a client."
+    )
+    s3_client.add_argument(
+        "--latency", type=float, default=0.5, help="Seconds taken by the credentials script."
+    )
+    s3_client.set_defaults(func=bench_s3_client)
+
+    pipeline = subparsers.add_parser(
+        "pipeline", help="Time no-op runs, single-tool rebuilds and full rebuilds."
+    )
+    pipeline.add_argument("--tools", type=int, default=4, help="Number of tool repos.")
+    pipeline.add_argument("--commits", type=int, default=100, help="Initial history length.")
+    pipeline.add_argument("--runs", type=int, default=10, help="Runs per scenario.")
+    pipeline.add_argument(
+        "--git-latency", type=float, default=0.1, help="Seconds added to each remote git op."
+    )
+    pipeline.add_argument(
+        "--s3-latency", type=float, default=0.02, help="Seconds added to each S3 request."
+    )
+    pipeline.add_argument(
+        "--build-time", type=float, default=0.5, help="Seconds taken by each stub build."
+    )
+    pipeline.add_argument(
+        "--baseline", metavar="PATH", help="Compare with the results stored in PATH."
+    )
+    pipeline.add_argument("--save-baseline", metavar="PATH", help="Store the results in PATH.")
+    pipeline.add_argument(
+        "update_args",
+        nargs=argparse.REMAINDER,
+        help="Arguments for update_toolstate.py, after `--`.",
+    )
+    pipeline.set_defaults(func=bench_pipeline)
+
+    startup = subparsers.add_parser(
+        "startup", help="Time no-op runs of update_toolstate.py in fresh interpreters."
+    )
+    startup.add_argument("--tools", type=int, default=4, help="Number of tool repos.")
+    startup.add_argument("--runs", type=int, default=10, help="Runs per scenario.")
+    startup.set_defaults(func=bench_startup)
+
+    download = subparsers.add_parser(
+        "download", help="Time installer downloads from a flaky local HTTP server."
+    )
+    download.add_argument("--files", type=int, default=3, help="Number of files.")
+    download.add_argument("--size", type=int, default=8, help="MiB per file.")
+    download.add_argument(
+        "--bandwidth", type=float, default=32, help="MiB/s served to each connection."
+    )
+    download.add_argument(
+        "--drop-after",
+        type=int,
+        default=4,
+        help="MiB after which the first request for each file is dropped.",
+    )
+    download.set_defaults(func=bench_download)
+
+    return parser.parse_args()
+
+
+def bench_ls_remote(args, tmp_dir):
+    """Compares probing heads one by one with `get_head_versions`."""
+    sources = [make_bare_repo(osp.join(tmp_dir, f"tool{i}.git")) for i in range(args.repos)]
+    config = stub_config(sources)
+
+    with git_latency(tmp_dir, ls_remote=args.latency):
+        serial = timed(lambda: [update_toolstate.get_head_rev(s) for s in sources])
+        concurrent = timed(lambda: update_toolstate.get_head_versions(config))
+
+    report("ls-remote (serial)", serial)
+    report("ls-remote (get_head_versions)", concurrent, baseline=serial)
+
+
+def bench_clone(args, tmp_dir):
+    """Compares cold checkouts of a large-history repo by each clone strategy, with and
+       without a warm local mirror."""
+    source = make_bare_repo(osp.join(tmp_dir, "tool.git"), args.commits, args.file_size)
+    ver = update_toolstate.get_head_rev(source)
+    mirrors_dir = osp.join(tmp_dir, "mirrors")
+    builds.SourceFetcher(mirrors_dir=mirrors_dir).checkout(source, ver, osp.join(tmp_dir, "warmup"))
+
+    baseline = None
+    for strategy in ["full", "partial", "shallow"]:
+        for mirrors in [None, mirrors_dir]:
+            repo_dir = osp.join(tmp_dir, f"{strategy}-{bool(mirrors)}")
+            fetcher = builds.SourceFetcher(strategy, mirrors)
+            secs = timed(lambda f=fetcher, d=repo_dir: f.checkout(source, ver, d))
+            git_size = builds.dir_size(osp.join(repo_dir, ".git")) / 2 ** 20
+            name = f"clone {strategy}{' (mirror)' if mirrors else ''}, {git_size:.1f} MiB"
+            report(name, secs, baseline=baseline)
+            baseline = baseline or secs
+
+
+def bench_s3_client(args, tmp_dir):
+    """Compares fetching credentials and creating a client for every use of S3 with
+       `get_s3_client`, using a stub credentials script."""
+    creds_script = osp.join(tmp_dir, "get-s3-creds.sh")
+    with open(creds_script, "w") as f_creds:
+        f_creds.write(f"#!/bin/sh\nsleep {args.latency}\nprintf 'AKIA\\tsecret\\ttoken'\n")
+    os.chmod(creds_script, 0o755)
+    publishing.S3_CREDS_SCRIPT = creds_script
+
+    def _client_per_use():
+        import boto3  # pylint: disable=import-outside-toplevel
+
+        for _ in range(args.uses):
+            creds = runner.run(creds_script, stdout=subprocess.PIPE).stdout.split("\t")
+            boto3.client(
+                "s3",
+                aws_access_key_id=creds[0],
+                aws_secret_access_key=creds[1],
+                aws_session_token=creds[2],
+            ).get_paginator("list_objects_v2")
+
+    def _shared_client():
+        publishing.get_s3_client.cache_clear()
+        for _ in range(args.uses):
+            s3 = publishing.get_s3_client()
+            s3.get_paginator("list_objects_v2")
+        s3._request_signer._credentials.get_frozen_credentials()  # pylint: disable=protected-access
+
+    per_use = timed(_client_per_use)
+    report("s3 client per use", per_use)
+    report("s3 client (get_s3_client)", timed(_shared_client), baseline=per_use)
+
+
+def bench_download(args, tmp_dir):
+    """Compares fetching files one by one with plain `curl`, which restarts dropped
+       transfers, with the installer's `Downloader`, cold and then cached."""
+    files = {f"/file{i}": os.urandom(args.size * 2 ** 20) for i in range(args.files)}
+    server = FlakyHTTPServer(files, args.bandwidth * 2 ** 20, args.drop_after * 2 ** 20)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = {f"http://127.0.0.1:{server.server_port}{path}": body for path, body in files.items()}
+
+    def _serial():
+        for i, url in enumerate(urls):
+            out_path = osp.join(tmp_dir, f"serial{i}")
+            curl = ["curl", "-sSfL", "-o", out_path, url]
+            while subprocess.run(curl, stderr=subprocess.DEVNULL, check=False).returncode:
+                pass
+
+    downloader = installer.Downloader(osp.join(tmp_dir, "downloads"))
+
+    def _downloader():
+        downloads = [
+            installer.Background(downloader.download, url, hashlib.sha256(body).hexdigest())
+            for url, body in urls.items()
+        ]
+        for download in downloads:
+            download.result()
+
+    serial = timed(_serial)
+    server.dropped.clear()
+    report("download serial (curl)", serial)
+    report("download (Downloader)", timed(_downloader), baseline=serial)
+    report("download cached (Downloader)", timed(_downloader), baseline=serial)
+    server.shutdown()
+
+
+class FlakyHTTPServer(ThreadingHTTPServer):
+    """Serves `files` ({ <path>: <bytes> }) at `rate` bytes/s per connection, honoring
+       range requests. The first response for each path is cut off after `drop_after` bytes."""
+
+    daemon_threads = True
+
+    def __init__(self, files, rate, drop_after):
+        self.files = files
+        self.rate = rate
+        self.drop_after = drop_after
+        self.dropped = set()
+        super().__init__(("127.0.0.1", 0), _FlakyHTTPHandler)
+
+
+class _FlakyHTTPHandler(BaseHTTPRequestHandler):
+    # pylint: disable=invalid-name,missing-docstring
+
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        start = 0
+        range_match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if range_match:
+            start = int(range_match.group(1))
+            if start >= len(body):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+
+        end = len(body)
+        if self.path not in self.server.dropped:
+            self.server.dropped.add(self.path)
+            end = min(end, start + self.server.drop_after)
+        chunk_size = 2 ** 16
+        for offset in range(start, end, chunk_size):
+            self.wfile.write(body[offset : min(offset + chunk_size, end)])
+            time.sleep(chunk_size / self.server.rate)
+
+
+def bench_pipeline(args, tmp_dir):
+    """Times `update_toolstate.update` end to end in each scenario and reports the p50 and
+       p95 run times, compared with a stored baseline if one is given."""
+    sources = [
+        make_bare_repo(osp.join(tmp_dir, f"tool{i}.git"), args.commits) for i in range(args.tools)
+    ]
+    config_path = write_config(
+        osp.join(tmp_dir, "config.yml"), sources, f"sleep {args.build_time} && cp data.txt {{tool}}"
+    )
+
+    s3 = FakeS3(latency=args.s3_latency)
+    update_toolstate.get_s3_client = lambda *_: s3
+    s3_server = s3.serve_http()
+    publishing.BIN_BUCKET_URL = f"http://127.0.0.1:{s3_server.server_port}"
+    update_args = [arg for arg in args.update_args if arg != "--"]
+    update_args = update_toolstate._parse_args(  # pylint: disable=protected-access
+        ["--config", config_path] + update_args
+    )
+    update_toolstate.configure_runner(update_args)
+
+    scenarios = {
+        "no-op": lambda: None,
+        "single-tool rebuild": lambda: add_commits(sources[0][len("file://") :]),
+        "full rebuild": lambda: [add_commits(source[len("file://") :]) for source in sources],
+    }
+    results = {}
+    with git_latency(tmp_dir, ls_remote=args.git_latency, fetch=args.git_latency):
+        timed(lambda: update_toolstate.update(update_args))  # populates the bucket
+        for scenario, prepare in scenarios.items():
+            samples = []
+            for _ in range(args.runs):
+                prepare()
+                samples.append(timed(lambda: update_toolstate.update(update_args)))
+            results[scenario] = {"p50": percentile(samples, 50), "p95": percentile(samples, 95)}
+
+    report_results(results, args.baseline)
+    print(f"S3 requests: {s3.requests}")
+    s3_server.shutdown()
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f_baseline:
+            json.dump(results, f_baseline, indent=2)
+
+
+def bench_startup(args, tmp_dir):
+    """Times runs of `update_toolstate.py` that find nothing to update, each in a fresh
+       interpreter as cron would start it, with and without the validated config cached.
+       The manifest is served by a local HTTP server; as no S3 client should be created,
+       a run that tries to fetch credentials fails. Importing boto3 is timed for reference."""
+    sources = [make_bare_repo(osp.join(tmp_dir, f"tool{i}.git")) for i in range(args.tools)]
+    config_path = write_config(osp.join(tmp_dir, "config.yml"), sources)
+    with redirect_stdout(io.StringIO()):
+        head_versions = update_toolstate.get_head_versions(stub_config(sources))
+    manifest = {
+        "version": publishing.MANIFEST_VERSION,
+        "cache": head_versions,
+        "current": head_versions,
+    }
+    server = FlakyHTTPServer(
+        {f"/{update_toolstate.HOST_TARGET.manifest_key}": json.dumps(manifest).encode()},
+        rate=2 ** 40,
+        drop_after=2 ** 62,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    env = {
+        **os.environ,
+        "TOOLSTATE_BUCKET_URL": f"http://127.0.0.1:{server.server_port}",
+        "TOOLSTATE_TOOLS_DIR": osp.join(tmp_dir, "startup-tools"),
+    }
+    # As in the workflow, which uploads the traces of runs that have something to do.
+    update_cmd = [
+        sys.executable,
+        update_toolstate.__file__,
+        "--config",
+        config_path,
+        "--upload-trace",
+    ]
+    config_cache_path = osp.join(env["TOOLSTATE_TOOLS_DIR"], "validated-config.json")
+
+    def _cold_config():
+        if osp.exists(config_cache_path):
+            os.remove(config_cache_path)
+        subprocess.run(update_cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+
+    scenarios = {
+        "import boto3, yaml, schema": lambda: subprocess.run(
+            [sys.executable, "-c", "import boto3, yaml, schema"], check=True
+        ),
+        "no-op (config not cached)": _cold_config,
+        "no-op": lambda: subprocess.run(update_cmd, env=env, stdout=subprocess.DEVNULL, check=True),
+    }
+    for scenario, func in scenarios.items():
+        samples = [timed(func) for _ in range(args.runs)]
+        report(f"{scenario} p50", percentile(samples, 50))
+        report(f"{scenario} p95", percentile(samples, 95))
+    server.shutdown()
+
+
+class FakeS3:
+    """An in-memory stand-in for the parts of the boto3 S3 client that update_toolstate
+       uses. Every request takes `latency` seconds."""
+
+    # pylint: disable=invalid-name,unused-argument,missing-docstring,too-few-public-methods
+
+    class exceptions:  # mirrors `client.exceptions`
+        ClientError = botocore.exceptions.ClientError
+
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, latency=0):
+        self.objects = {}
+        self.last_modified = {}
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def get_object(self, Bucket, Key, **_):
+        self._request()
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def head_object(self, Bucket, Key, **_):
+        self._request()
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[Key]), "Metadata": {}}
+
+    def put_object(self, Bucket, Key, Body, **_):
+        self._request()
+        self._store(Key, Body)
+
+    def _store(self, key, body):
+        self.objects[key] = body
+        self.last_modified[key] = datetime.now(timezone.utc)
+
+    def upload_file(self, Filename, Bucket, Key, **_):
+        self._request()
+        with open(Filename, "rb") as f_upload:
+            self._store(Key, f_upload.read())
+
+    def download_file(self, Bucket, Key, Filename, **_):
+        with open(Filename, "wb") as f_download:
+            f_download.write(self.get_object(Bucket, Key)["Body"].read())
+
+    def copy_object(self, Bucket, Key, CopySource, **_):
+        self._request()
+        self._store(Key, self.objects[CopySource["Key"]])
+
+    def delete_objects(self, Bucket, Delete, **_):
+        self._request()
+        for obj in Delete["Objects"]:
+            self.objects.pop(obj["Key"], None)
+            self.last_modified.pop(obj["Key"], None)
+
+    def serve_http(self):
+        """Starts serving the objects anonymously over HTTP, like the public bucket."""
+        fake_s3 = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                fake_s3._request()  # pylint: disable=protected-access
+                body = fake_s3.objects.get(self.path[1:])
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        for i in range(0, max(len(keys), 1), 1000):
+            self._request()
+            yield {
+                "Contents": [
+                    {"Key": key, "LastModified": self.last_modified[key]}
+                    for key in keys[i : i + 1000]
+                ]
+            }
+
+
+def make_bare_repo(path, commits=1, file_size=64):
+    """Creates a bare repo at `path` with a linear master history of `commits` commits,
+       each rewriting one `file_size`-byte file of incompressible data. Returns the repo's
+       `file://` URL."""
+    subprocess.run([GIT, "init", "-q", "--bare", path], check=True)
+    subprocess.run([GIT, "-C", path, "config", "uploadpack.allowFilter", "true"], check=True)
+    add_commits(path, commits, file_size)
+    return f"file://{path}"
+
+
+def add_commits(path, commits=1, file_size=64):
+    """Adds `commits` commits to master of the bare repo at `path`."""
+    has_master = subprocess.run(
+        [GIT, "-C", path, "rev-parse", "-q", "--verify", "master"],
+        stdout=subprocess.DEVNULL,
+        check=False,
+    )
+    stream = io.BytesIO()
+    for i in range(commits):
+        blob = os.urandom(file_size)
+        msg = b"commit %d" % i
+        stream.write(b"commit refs/heads/master\n")
+        stream.write(b"committer bench <bench@localhost> %d +0000\n" % time.time())
+        stream.write(b"data %d\n%s\n" % (len(msg), msg))
+        if i == 0 and has_master.returncode == 0:
+            stream.write(b"from refs/heads/master^0\n")
+        stream.write(b"M 644 inline data.txt\ndata %d\n%s\n" % (len(blob), blob))
+    subprocess.run([GIT, "-C", path, "fast-import", "--quiet"], input=stream.getvalue(), check=True)
+
+
+def stub_config(sources, builder="true"):
+    """Returns a stand-in for `update_toolstate.Config` with one tool per source."""
+    tools = {
+        f"tool{i}": update_toolstate.Config.Tool(f"tool{i}", source, builder)
+        for i, source in enumerate(sources)
+    }
+    return SimpleNamespace(tools=tools, sources=lambda: set(sources))
+
+
+def write_config(path, sources, builder="true"):
+    """Writes a config with one tool per source to `path` and returns it. `{tool}` in the
+       `builder` is replaced by the tool's name."""
+    with open(path, "w") as f_config:
+        yaml.safe_dump(
+            {
+                "tools": {
+                    f"tool{i}": {"source": source, "builder": builder.format(tool=f"tool{i}")}
+                    for i, source in enumerate(sources)
+                },
+                "canaries": [],
+            },
+            f_config,
+        )
+    return path
+
+
+@contextmanager
+def git_latency(tmp_dir, **latencies):
+    """Puts a `git` shim on the PATH that sleeps before running the given subcommands,
+       e.g. `ls_remote=0.3`, to simulate round trips to a remote."""
+    shim_dir = osp.join(tmp_dir, "shim")
+    os.makedirs(shim_dir, exist_ok=True)
+    cases = "".join(
+        f"  {cmd.replace('_', '-')}) sleep {secs} ;;\n" for cmd, secs in latencies.items()
+    )
+    with open(osp.join(shim_dir, "git"), "w") as f_shim:
+        f_shim.write(f'#!/bin/sh\ncase "$1" in\n{cases}esac\nexec {GIT} "$@"\n')
+    os.chmod(osp.join(shim_dir, "git"), 0o755)
+
+    orig_path = os.environ["PATH"]
+    os.environ["PATH"] = f"{shim_dir}:{orig_path}"
+    update_toolstate.RUNNER.refresh_env()
+    try:
+        yield
+    finally:
+        os.environ["PATH"] = orig_path
+        update_toolstate.RUNNER.refresh_env()
+
+
+def timed(func):
+    """Returns the wall time of `func()` in seconds, discarding what it prints."""
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        func()
+    return time.perf_counter() - start
+
+
+def percentile(samples, pct):
+    """Returns the nearest-rank `pct`th percentile of `samples`."""
+    samples = sorted(samples)
+    return samples[max(math.ceil(pct / 100 * len(samples)) - 1, 0)]
+
+
+def report_results(results, baseline_path=None):
+    """Reports the `{ <scenario>: { <stat>: <secs> } }` results, compared with those stored
+       at `baseline_path`, if given."""
+    baseline = {}
+    if baseline_path:
+        with open(baseline_path) as f_baseline:
+            baseline = json.load(f_baseline)
+    for scenario, stats in results.items():
+        for stat, secs in stats.items():
+            report(f"{scenario} {stat}", secs, baseline=baseline.get(scenario, {}).get(stat))
+
+
+def report(name, secs, baseline=None):
+    speedup = f"  ({baseline / secs:.1f}x)" if baseline else ""
+    print(f"{name:<40} {secs * 1000:9.1f} ms{speedup}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""The dirs and bucket that the toolstate is kept in, and the platforms tools are built for."""
+
+from collections import namedtuple
+import os
+import os.path as osp
+import platform
+import sys
+
+__all__ = [
+    "BASE_DIR",
+    "TOOLS_DIR",
+    "BIN_DIR",
+    "BIN_BUCKET",
+    "Target",
+    "TARGETS",
+    "HOST_TARGET",
+    "get_s3_key",
+    "parse_s3_key",
+]
+
+BASE_DIR = osp.abspath(osp.dirname(__file__))
+TOOLS_DIR = os.environ.get("TOOLSTATE_TOOLS_DIR", osp.join(BASE_DIR, "tools"))
+BIN_DIR = osp.join(TOOLS_DIR, "bin")
+BIN_BUCKET = "tools.oasis.dev"
+# The index of the current tools, which is what `installer.py` reads.
+INDEX_NAME = "index.json"
+
+
+class Target(namedtuple("Target", "name prefix rust_triple goos goarch")):
+    """A platform that tools are built for. Its tools are published under `<prefix>/`,
+       which is `sys.platform` for x86_64 targets, since that's where `installer.py` looks."""
+
+    __slots__ = ()
+
+    @property
+    def cache_pfx(self):
+        """The prefix of the tools that were built but have not been released."""
+        return f"{self.prefix}/cache/"
+
+    @property
+    def cd_pfx(self):
+        """The prefix of the released tools."""
+        return f"{self.prefix}/current/"  # cd = continuous deployment
+
+    @property
+    def manifest_key(self):
+        """The key of the manifest of cached and current versions."""
+        return f"{self.prefix}/manifest.json"
+
+    @property
+    def index_key(self):
+        """The key of the index of current tools."""
+        return self.cd_pfx + INDEX_NAME
+
+    @property
+    def objects_pfx(self):
+        """The prefix of the tools published by content, which the index refers to."""
+        return f"{self.prefix}/objects/"
+
+    @property
+    def bin_dir(self):
+        """The dir that tools built for this target are put in."""
+        return osp.join(BIN_DIR, self.name)
+
+    def build_envs(self):
+        """Returns the env vars that tell a builder which target to build for."""
+        envs = {"TOOLSTATE_TARGET": self.name}
+        if self.goos is not None:
+            envs.update(GOOS=self.goos, GOARCH=self.goarch)
+        if self != HOST_TARGET:
+            envs["CARGO_BUILD_TARGET"] = self.rust_triple
+        return envs
+
+
+TARGETS = {
+    target.name: target
+    for target in [
+        Target("linux-x86_64", "linux", "x86_64-unknown-linux-gnu", "linux", "amd64"),
+        Target("linux-aarch64", "linux-aarch64", "aarch64-unknown-linux-gnu", "linux", "arm64"),
+        Target("darwin-x86_64", "darwin", "x86_64-apple-darwin", "darwin", "amd64"),
+    ]
+}
+
+
+def _host_target():
+    name = f"{sys.platform}-{platform.machine().replace('arm64', 'aarch64')}"
+    return TARGETS.get(name, Target(name, name, None, None, None))
+
+
+HOST_TARGET = _host_target()
+
+
+def get_s3_key(prefix, tool, version):
+    """Returns the key for the tool and version under the provided prefix."""
+    return osp.join(prefix, f"{tool}-{version}")
+
+
+def parse_s3_key(key):
+    """Parses the S3 object path into (name, ver)."""
+    return key.rsplit("/", 1)[-1].rsplit("-", 1)
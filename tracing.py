@@ -0,0 +1,77 @@
+"""Records the steps of a run as Chrome trace events."""
+
+from contextlib import contextmanager
+import os
+import resource
+import sys
+import threading
+import time
+
+__all__ = ["Tracer", "TRACER"]
+
+
+class Tracer:
+    """Records the steps of a run as Chrome trace events, which can be viewed using
+       chrome://tracing or https://ui.perfetto.dev. CPU time and child process figures
+       are process-wide, so they include the work of any concurrently running spans."""
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._thread_ids = {}
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, cat, **span_args):
+        """Records the enclosed block. Yields the span's args, which the block can add to."""
+        start = time.perf_counter()
+        cpu_start, children_cpu_start = time.process_time(), _children_cpu_time()
+        try:
+            yield span_args
+        finally:
+            span_args["cpu_s"] = round(time.process_time() - cpu_start, 6)
+            span_args["children_cpu_s"] = round(_children_cpu_time() - children_cpu_start, 6)
+            span_args["children_max_rss_kib"] = _children_max_rss_kib()
+            self.add_span(name, cat, start, **span_args)
+
+    def add_span(self, name, cat, start, **span_args):
+        """Records a span from `start`, a `time.perf_counter()`, until now."""
+        end = time.perf_counter()
+        with self._lock:
+            tid = self._thread_ids.setdefault(threading.get_ident(), len(self._thread_ids))
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": cat,
+                    "ph": "X",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "ts": round((start - self._origin) * 1e6),
+                    "dur": round((end - start) * 1e6),
+                    "args": span_args,
+                }
+            )
+
+    def report(self, **metadata):
+        """Returns the recorded spans in the Chrome trace event format."""
+        with self._lock:
+            return {"traceEvents": list(self.events), "otherData": metadata}
+
+    def clear(self):
+        """Forgets the recorded spans, so that the next report covers only later ones."""
+        with self._lock:
+            self.events = []
+            self._origin = time.perf_counter()
+
+
+def _children_cpu_time():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def _children_max_rss_kib():
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max_rss // 1024 if sys.platform == "darwin" else max_rss  # darwin reports bytes
+
+
+TRACER = Tracer()
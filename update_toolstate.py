@@ -1,272 +1,787 @@
 #!/usr/bin/env python3
 """Builds, tests, and publishes the latest versions of the Oasis toolchain."""
 
+import argparse
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
 import os
 import os.path as osp
+import queue
 import shutil
+import struct
 import subprocess
-from subprocess import PIPE, DEVNULL
+from subprocess import PIPE, DEVNULL, STDOUT
 import sys
+import threading
+import time
 
-import boto3
-import schema
-import yaml
+from builds import build_tools, BuildCache, BuildScheduler, CargoCache, plan_builds, SourceFetcher
+from publishing import get_s3_client, get_versions, Publisher, read_public_manifest, S3Transfers
+from runner import AsyncBackend, DryRunBackend, RecordingBackend, ReplayBackend, run, RUNNER
+from targets import BASE_DIR, BIN_BUCKET, HOST_TARGET, TARGETS, TOOLS_DIR
+from tracing import TRACER
+
+# schema and yaml are imported where they're used, since importing them takes longer than
+# a run that finds nothing to update.
 
-BASE_DIR = osp.abspath(osp.dirname(__file__))
-TOOLS_DIR = osp.join(BASE_DIR, "tools")
-BIN_DIR = osp.join(TOOLS_DIR, "bin")
 CANARIES_DIR = osp.join(BASE_DIR, "canaries")
+TEST_CACHE_PATH = osp.join(TOOLS_DIR, "passed-tests.json")
+CONFIG_CACHE_PATH = osp.join(TOOLS_DIR, "validated-config.json")
 MYPROJ = "my_project"
-BIN_BUCKET = "tools.oasis.dev"
-CACHE_BIN_PFX = f"{sys.platform}/cache/"
-CD_BIN_PFX = f"{sys.platform}/current/"  # cd = continuous deployment
+LS_REMOTE_TIMEOUT = 30  # seconds
+LS_REMOTE_ATTEMPTS = 3
+# Dirs whose manifests belong to a project's dependencies rather than to the project.
+VENDORED_DIRS = {"node_modules", "vendor", "target"}
+TRACES_PFX = f"{sys.platform}/traces/"
 
 
 class Config:
     """Tools config object."""
 
-    GITHUB_REPO_RE = schema.Regex(r"\w+/\w+")
-    CONFIG_SCHEMA = schema.Schema(
-        {
-            "tools": {
-                str: {"source": GITHUB_REPO_RE, schema.Optional("builder", default=None): str}
-            },
-            "canaries": [GITHUB_REPO_RE],
-        }
-    )
-
-    Tool = namedtuple("Tool", "name source builder")
+    Tool = namedtuple("Tool", "name source builder cpus memory", defaults=(None, None))
+    Canary = namedtuple("Canary", "source tools")  # `tools` is None if undeclared
 
-    def __init__(self, config_obj):
-        config = self.CONFIG_SCHEMA.validate(config_obj)
+    def __init__(self, config_obj, validated=False):
+        config = config_obj if validated else self.config_schema().validate(config_obj)
         self.tools = {
-            name: self.Tool(name, self._fmt_github_url(spec["source"]), spec["builder"])
+            name: self.Tool(
+                name,
+                self._fmt_github_url(spec["source"]),
+                spec["builder"],
+                spec["cpus"],
+                spec["memory"],
+            )
             for name, spec in config["tools"].items()
         }
-        self.canaries = list(map(self._fmt_github_url, config_obj["canaries"]))
+        self.canaries = [
+            self.Canary(self._fmt_github_url(spec), None)
+            if isinstance(spec, str)
+            else self.Canary(self._fmt_github_url(spec["source"]), spec["tools"])
+            for spec in config["canaries"]
+        ]
 
     @staticmethod
     def _fmt_github_url(owner_repo):
+        if "://" in owner_repo:  # already a URL, e.g. of a local repo
+            return owner_repo
         return f"https://github.com/{owner_repo}"
 
     def sources(self):
         return {t.source for t in self.tools.values()}
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def config_schema():
+        """Returns the schema that configs are validated and given defaults with."""
+        import schema  # pylint: disable=import-outside-toplevel
+
+        github_repo_re = schema.Regex(r"\w+/\w+")
+        positive_number = schema.And(schema.Or(int, float), lambda n: n > 0)
+        return schema.Schema(
+            {
+                "tools": {
+                    str: {
+                        "source": github_repo_re,
+                        schema.Optional("builder", default=None): str,
+                        # The CPUs and GiB of memory that building the tool takes.
+                        schema.Optional("cpus", default=None): positive_number,
+                        schema.Optional("memory", default=None): positive_number,
+                    }
+                },
+                "canaries": [
+                    schema.Or(
+                        github_repo_re,
+                        {"source": github_repo_re, schema.Optional("tools", default=None): [str]},
+                    )
+                ],
+            }
+        )
 
-def main():
-    with open("config.yml") as f_config:
-        config = Config(yaml.safe_load(f_config))
 
-    with s3_client() as s3:
-        head_versions = get_head_versions(config)
-        cached_versions = get_cached_versions(s3)
+def load_config(path, cache_path=CONFIG_CACHE_PATH):
+    """Returns the `Config` in the file at `path`. The validated config is cached in
+       `cache_path`, keyed by the hashes of the file and of this script, so that unchanged
+       configs needn't be parsed and validated again."""
+    with open(path, "rb") as f_config:
+        config_yml = f_config.read()
+    with open(__file__, "rb") as f_script:
+        cache_key = hashlib.sha256(config_yml + f_script.read()).hexdigest()
+    try:
+        with open(cache_path) as f_cache:
+            cached = json.load(f_cache)
+        if cached["key"] == cache_key:
+            return Config(cached["config"], validated=True)
+    except (OSError, ValueError, KeyError):
+        pass
 
-    to_build = {}  # name: ver
-    for tool, cur_ver in head_versions.items():
-        if cached_versions.get(tool) != cur_ver:
-            to_build[tool] = cur_ver
+    import yaml  # pylint: disable=import-outside-toplevel
 
-    if not to_build:
-        print(f"current: {' '.join('-'.join(name_ver) for name_ver in head_versions.items())}")
-        return
+    config_obj = Config.config_schema().validate(yaml.safe_load(config_yml))
+    os.makedirs(osp.dirname(cache_path), exist_ok=True)
+    with open(f"{cache_path}.tmp", "w") as f_cache:
+        json.dump({"key": cache_key, "config": config_obj}, f_cache)
+    os.replace(f"{cache_path}.tmp", cache_path)
+    return Config(config_obj, validated=True)
 
-    update_current = False
+
+def main():
+    args = _parse_args()
+    configure_runner(args)
+    if args.watch:
+        watch(args)
+    else:
+        traced_update(args)
+
+
+def configure_runner(args):
+    """Sets the backend of the `RUNNER` that executes, replays or records commands."""
+    RUNNER.backend = AsyncBackend()
+    if args.replay_commands:
+        RUNNER.backend = ReplayBackend(args.replay_commands)
+    elif args.dry_run:
+        RUNNER.backend = DryRunBackend()
+    if args.record_commands:
+        RUNNER.backend = RecordingBackend(RUNNER.backend, args.record_commands)
+
+
+def traced_update(args):
+    """Runs `update` and writes its trace, if one was requested. The traces of runs that
+       found nothing to do aren't uploaded, since that would need the S3 credentials."""
+    TRACER.clear()
+    started_at = datetime.now(timezone.utc)
+    upload = args.upload_trace
     try:
-        new_tools = [(config.tools[name], ver) for name, ver in to_build.items()]
-        build_tools(new_tools)
-        # run_tests(config)
-        update_current = True
+        upload = update(args) and upload
     finally:
-        with s3_client() as s3:
-            sync_tools(head_versions, cached_versions, update_current, s3)
-
-
-def build_tools(tool_vers):
-    """Builds new tools."""
-    shutil.rmtree(BIN_DIR, ignore_errors=True)
-    os.makedirs(BIN_DIR)
-    for (tool, ver) in tool_vers:
-        repo_dir = osp.join(TOOLS_DIR, tool.source.rsplit("/", 1)[-1])
-        if not osp.isdir(repo_dir):
-            run(f"git clone -q {tool.source} {repo_dir}")
-        with pushd(repo_dir):
-            run(f"git fetch origin && git checkout -q {ver}")
-            if tool.builder is not None:
-                run(tool.builder)
-                shutil.copy(tool.name, BIN_DIR)
-            elif osp.isfile("Cargo.toml"):
-                run(f"cargo build -q --locked --release --bin {tool.name}",)
-                shutil.copy(osp.join("target", "release", tool.name), BIN_DIR)
-            elif osp.isfile("go.mod"):
-                raise RuntimeError("auto go build are not yet supported. please specify `builder`")
-            else:
-                raise RuntimeError("unable to auto-detect project type")
-
-
-def run_tests(config):
-    # pylint: disable=unused-variable
-    """Builds, unit tests, and locally deploys all projects found in canary repos
-       and the starter repo produced by `oasis init`."""
-
-    canaries = config.get("canaries", [])
-    if not canaries:
-        return
-
-    run("oasis", input="y\n", stdout=DEVNULL, check=False)  # gen config if needed
-
-    with oasis_chain():
-        for canary in canaries:
-            canary_dir = osp.split(canary)[-1]
-            with pushd(osp.join(CANARIES_DIR, canary_dir)):
-                if osp.isdir(".git"):
-                    run(
-                        "git fetch origin && git reset --hard origin/master",
-                        stdout=DEVNULL,
-                        stderr=DEVNULL,
-                    )
-                else:
-                    run(
-                        f"git clone -q --depth 1 https://github.com/{canary} .", stdout=DEVNULL,
-                    )
+        if args.trace or upload:
+            write_trace(args, started_at, upload)
+
+
+def watch(args):
+    """Runs `update` whenever tools change, for as long as the process lives, so that the
+       S3 client, clones and build caches stay warm. Changes are noticed by polling the
+       heads of the tools every `args.poll_interval` seconds or by POSTs to a local webhook
+       endpoint on `args.webhook_port`. Bursts of changes are debounced: a run starts once
+       no change has been seen for `args.debounce` seconds. A failed run is retried after
+       `args.poll_interval` seconds, since polling won't notice the heads changing again."""
+    # pylint: disable=import-outside-toplevel
+    import boto3.exceptions
+    import botocore.exceptions
+    import schema
+    import yaml
+
+    triggers = queue.Queue()
+    if args.webhook_port:
+        server = ThreadingHTTPServer(("127.0.0.1", args.webhook_port), _WebhookHandler)
+        server.triggers = triggers
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=_poll_heads, args=(args, triggers), daemon=True).start()
+
+    while True:
+        reasons = {triggers.get()}
+        while True:
+            try:
+                reasons.add(triggers.get(timeout=args.debounce))
+            except queue.Empty:
+                break
+        print(f"+ updating after: {'; '.join(sorted(reasons))}")
+        try:
+            traced_update(args)
+        except (
+            OSError,
+            RuntimeError,
+            subprocess.CalledProcessError,
+            subprocess.TimeoutExpired,
+            boto3.exceptions.Boto3Error,
+            botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError,
+            schema.SchemaError,
+            ValueError,
+            yaml.YAMLError,
+        ) as err:
+            print(f"! update failed: {err!r}")
+            retry = threading.Timer(args.poll_interval, triggers.put, ["retry of failed update"])
+            retry.daemon = True
+            retry.start()
+
+
+def _poll_heads(args, triggers):
+    """Queues a trigger whenever the heads of the tools differ from the last poll's. Errors
+       are logged and polling goes on, since nothing else would notice changes otherwise."""
+    last_head_versions = {}
+    while True:
+        try:
+            config = load_config(args.config)
+            head_versions = get_head_versions(config)
+        except Exception as err:  # pylint: disable=broad-except
+            print(f"! polling failed: {err!r}")
+        else:
+            changed = sorted(
+                f"{tool}-{ver}"
+                for tool, ver in head_versions.items()
+                if last_head_versions.get(tool) != ver
+            )
+            if changed:
+                triggers.put(f"new heads {' '.join(changed)}")
+            last_head_versions = head_versions
+        time.sleep(args.poll_interval)
 
-                # Build services before apps. Each is done individually because a canary
-                # repo might contain multiple projects.
-                for service_manifest in find_manifests("Cargo.toml"):
-                    with pushd(osp.dirname(service_manifest)):
-                        run("oasis build -q")
-                        run("oasis test -q")
 
-                for app_manifest in find_manifests("package.json"):
-                    with pushd(osp.dirname(app_manifest)):
-                        run("yarn install -s")
-                        run("oasis test -q")
+class _WebhookHandler(BaseHTTPRequestHandler):
+    """Queues a trigger for each POST, e.g. from a push webhook relayed to the host."""
 
-        myproj_dir = osp.join(CANARIES_DIR, MYPROJ)
-        run(f"rm -rf {myproj_dir} && oasis init -qq {myproj_dir}")
-        with pushd(myproj_dir):
-            # In the quickstart, we can assume that the root contains only one project.
-            run("oasis build -q")
-            run("oasis test -q")
+    # pylint: disable=invalid-name,missing-function-docstring
 
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.triggers.put(f"webhook {self.path}")
+        self.send_response(202)
+        self.end_headers()
 
-def find_manifests(*names):
-    """Returns the paths of all files in `names` in the repo containing cwd."""
-    names_alt = "\\|".join(names)
-    return run(f'git ls-files | grep -e "{names_alt}"', stdout=PIPE).stdout.split()
+    def log_message(self, *_):
+        pass
 
 
-def sync_tools(head_versions, cached_versions, update_current, s3):
-    """Uploads built artifacts to the s3 under the current-but-not-released prefex.
-       Removes any outdated artifacts."""
-    current_versions = get_current_versions(s3)
-    built_tools = {de.name for de in os.scandir(BIN_DIR)}
+def update(args):
+    """Builds, tests, and publishes the tools that changed since the last run, and returns
+       whether there were any. The S3 client is only created once the manifests, which are
+       read anonymously, show that there's something to do, so that runs that find nothing
+       to do return quickly."""
+    config = load_config(args.config)
 
-    to_delete = []
+    with ThreadPoolExecutor(max_workers=len(args.targets)) as pool:
+        manifests = [] if args.no_manifest else pool.map(read_public_manifest, args.targets)
+        head_versions = get_head_versions(config)
+        manifests = list(manifests)
+    s3 = None
+    if manifests and all(manifests):
+        target_versions = {
+            target: (manifest["cache"], manifest["current"])
+            for target, manifest in zip(args.targets, manifests)
+        }
+    else:
+        s3 = _get_s3_client(args)
+        with ThreadPoolExecutor(max_workers=len(args.targets)) as pool:
+            target_versions = dict(
+                zip(
+                    args.targets,
+                    pool.map(
+                        lambda target: get_versions(s3, target, use_manifest=not args.no_manifest),
+                        args.targets,
+                    ),
+                )
+            )
 
-    def _upload_tool(prefix, tool):
-        s3.upload_file(
-            osp.join(BIN_DIR, tool), BIN_BUCKET, get_s3_key(prefix, tool, head_versions[tool]),
-        )
+    plan = plan_builds(
+        config.tools,
+        head_versions,
+        {target: cached_versions for target, (cached_versions, _) in target_versions.items()},
+    )
+    if not plan:
+        print(f"current: {' '.join('-'.join(name_ver) for name_ver in head_versions.items())}")
+        return False
+    s3 = s3 or _get_s3_client(args)
 
-    for tool in built_tools:
-        _upload_tool(CACHE_BIN_PFX, tool)
-        cached_version = cached_versions.get(tool)
-        if cached_version:
-            to_delete.append(get_s3_key(CACHE_BIN_PFX, tool, cached_version))
-
-    if update_current:
-        to_delete.extend(
-            get_s3_key(CD_BIN_PFX, tool, ver)
-            for tool, ver in current_versions.items()
-            if head_versions.get(tool) != ver
-        )
-        for tool, ver in head_versions.items():
-            cache_key = get_s3_key(CACHE_BIN_PFX, tool, ver)
-            cd_key = get_s3_key(CD_BIN_PFX, tool, ver)
-            s3.copy_object(
-                Bucket=BIN_BUCKET, Key=cd_key, CopySource=dict(Bucket=BIN_BUCKET, Key=cache_key)
+    update_current = False
+    try:
+        build_cache = BuildCache(max_size=args.build_cache_size * 2 ** 30)
+        cargo_cache = None
+        if args.shared_cargo_cache:
+            cargo_cache = CargoCache(max_size=args.cargo_cache_size * 2 ** 30)
+        fetcher = SourceFetcher(args.clone, args.git_mirrors)
+        with TRACER.span("build_tools", "step", targets=[t.name for t in args.targets]):
+            build_tools(
+                plan,
+                scheduler=BuildScheduler(args.cpus, args.memory, max_jobs=args.jobs),
+                cache=build_cache,
+                cargo_cache=cargo_cache,
+                fetcher=fetcher,
             )
-        for tool in built_tools:
-            _upload_tool(CD_BIN_PFX, tool)
-
-    if to_delete:
-        s3.delete_objects(Bucket=BIN_BUCKET, Delete={"Objects": [{"Key": k} for k in to_delete]})
+        # run_tests(config, head_versions, jobs=args.jobs)
+        update_current = True
+    finally:
+        if not args.dry_run:
+            # Targets that weren't built for and whose current tools are up to date are left be.
+            outdated_versions = {
+                target: (cached_versions, current_versions)
+                for target, (cached_versions, current_versions) in target_versions.items()
+                if any(target in target_tool_vers for target_tool_vers in plan.values())
+                or (update_current and current_versions != head_versions)
+            }
+            publish(args, s3, head_versions, outdated_versions, update_current)
+    return True
+
+
+def publish(args, s3, head_versions, target_versions, update_current):
+    """Publishes the tools of each target in `target_versions`, with
+       `Publisher.publish_tools` or `Publisher.sync_tools` depending on `args`."""
+    transfers = S3Transfers(s3, args.s3_part_size * 2 ** 20, args.s3_concurrency)
+    with TRACER.span("sync_tools", "step", update_current=update_current), ThreadPoolExecutor(
+        max_workers=len(args.targets)
+    ) as pool:
+        syncs = [
+            pool.submit(
+                Publisher(transfers, target, args.deltas).publish_tools,
+                head_versions,
+                update_current,
+            )
+            if args.atomic_publish
+            else pool.submit(
+                Publisher(transfers, target, args.deltas).sync_tools,
+                head_versions,
+                cached_versions,
+                update_current,
+                current_versions,
+            )
+            for target, (cached_versions, current_versions) in target_versions.items()
+        ]
+    for sync in syncs:
+        sync.result()
+
+
+def _get_s3_client(args):
+    """Returns the run's shared S3 client, with enough connections for `args.s3_concurrency`
+       concurrent transfers of as many parts each."""
+    return get_s3_client(args.s3_concurrency ** 2)
+
+
+def write_trace(args, started_at, upload):
+    """Writes the run's trace to `args.trace` and, if `upload`, uploads it to the
+       `TRACES_PFX`."""
+    trace_json = json.dumps(
+        TRACER.report(started_at=started_at.isoformat(), argv=sys.argv[1:])
+    ).encode()
+    if args.trace:
+        with open(args.trace, "wb") as f_trace:
+            f_trace.write(trace_json)
+    if upload:
+        _get_s3_client(args).put_object(
+            Bucket=BIN_BUCKET,
+            Key=f"{TRACES_PFX}{started_at:%Y%m%dT%H%M%SZ}.json",
+            Body=trace_json,
+            ContentType="application/json",
+        )
 
 
-def get_head_versions(config):
-    """Returns { <tool-name>: <git-rev> } """
-    source_revs = {
-        source: run(f"git ls-remote {source} master | cut -f1", stdout=PIPE).stdout[:7]
-        for source in config.sources()
-    }
-    return {t.name: source_revs[t.source] for t in config.tools.values()}
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config", default="config.yml", help="Path of the tools config. Default: config.yml"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Maximum number of tool repos to build concurrently. Default: 1",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=float,
+        help="CPUs that concurrent builds may use between them. Default: all of them",
+    )
+    parser.add_argument(
+        "--memory",
+        type=float,
+        help="GiB of memory that concurrent builds may use between them. Default: all of it",
+    )
+    parser.add_argument(
+        "--targets",
+        type=_parse_targets,
+        default=[HOST_TARGET],
+        help="Comma-separated targets to build and publish the tools for, out of "
+        f"{', '.join(TARGETS)}. Default: {HOST_TARGET.name}",
+    )
+    parser.add_argument(
+        "--build-cache-size",
+        type=float,
+        default=4,
+        help="Size limit in GiB of the local cache of built binaries. Default: 4",
+    )
+    parser.add_argument(
+        "--shared-cargo-cache",
+        action="store_true",
+        help="Build all Rust tools in one shared target dir and compiler cache. "
+        "Cargo locks the target dir, so Rust builds will not overlap.",
+    )
+    parser.add_argument(
+        "--cargo-cache-size",
+        type=float,
+        default=10,
+        help="Size limit in GiB of the shared target dir and compiler cache. Default: 10",
+    )
+    parser.add_argument(
+        "--clone",
+        choices=sorted(SourceFetcher.CLONE_ARGS),
+        default="partial",
+        help="How much of each tool repo's history to fetch. Default: partial",
+    )
+    parser.add_argument(
+        "--git-mirrors",
+        metavar="DIR",
+        help="Keep bare mirrors of the tool repos in DIR and clone by reference to them.",
+    )
+    parser.add_argument(
+        "--s3-part-size",
+        type=int,
+        default=16,
+        help="Size in MiB of the parts of multipart uploads. Default: 16",
+    )
+    parser.add_argument(
+        "--s3-concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of concurrent S3 requests per transfer. Default: 8",
+    )
+    parser.add_argument(
+        "--no-manifest",
+        action="store_true",
+        help="List the bucket instead of reading tool versions from the manifest.",
+    )
+    parser.add_argument(
+        "--deltas",
+        action="store_true",
+        help="Also publish tools as xdelta3 patches of their current versions.",
+    )
+    parser.add_argument(
+        "--atomic-publish",
+        action="store_true",
+        help="Publish tools by content and switch the index to them in one conditional write, "
+        "so that concurrent runs can't publish a mix of their tools.",
+    )
+    parser.add_argument(
+        "--watch", action="store_true", help="Keep running and update whenever a tool changes.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60,
+        help="Seconds between polls of the tools' heads in --watch mode. Default: 60",
+    )
+    parser.add_argument(
+        "--webhook-port",
+        type=int,
+        help="Local port on which POSTs trigger an update in --watch mode.",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=30,
+        help="Seconds without changes to wait for before updating in --watch mode. Default: 30",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Write the timings of the run's steps to PATH as a Chrome trace.",
+    )
+    parser.add_argument(
+        "--upload-trace",
+        action="store_true",
+        help=f"Upload the timings of the run's steps to the bucket under {TRACES_PFX},"
+        " unless there was nothing to do.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Don't run commands, pretending that they succeed, nor publish anything.",
+    )
+    parser.add_argument(
+        "--record-commands",
+        metavar="PATH",
+        help="Append the results of the commands run to the JSON lines file at PATH.",
+    )
+    parser.add_argument(
+        "--replay-commands",
+        metavar="PATH",
+        help="Don't run commands, returning the results recorded in PATH instead.",
+    )
+    return parser.parse_args(argv)
 
 
-def get_current_versions(s3):
-    """Returns the current tools as `{ <tool name>: <version> }`."""
-    return _get_tools_in(s3, CD_BIN_PFX)
+def _parse_targets(names):
+    try:
+        return [TARGETS[name] for name in names.split(",")]
+    except KeyError as err:
+        raise argparse.ArgumentTypeError(f"unknown target {err}")
+
+
+TestResult = namedtuple("TestResult", "project manifest_dir error output")
+# The projects of a canary to test as `(<project>, <manifest dir>, <steps>)`s, the key with
+# which to record that they passed, if any, and the results of the canary's failed setup.
+CanaryTest = namedtuple("CanaryTest", "key projects results")
+
+# The steps that build and test each kind of project, keyed by its manifest.
+# Services are built before apps, since apps might depend on them.
+TEST_STEPS = {
+    "Cargo.toml": ["oasis build -q", "oasis test -q"],
+    "package.json": ["yarn install -s", "oasis test -q"],
+}
+# The tools exercised by each kind of project, for canaries that don't declare theirs.
+TEST_TOOLS = {
+    "Cargo.toml": ["oasis", "oasis-build"],
+    "package.json": ["oasis", "oasis-chain", "oasis-gateway"],
+}
+
+
+class TestCache:
+    """Records the canaries that passed with a given canary rev and tool versions, so that
+       they're only tested again once the canary or a tool that it exercises changes."""
+
+    def __init__(self, path=TEST_CACHE_PATH, max_entries=1024):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f_cache:
+                self._passed = json.load(f_cache)
+        except (FileNotFoundError, ValueError):
+            self._passed = {}
 
+    @staticmethod
+    def key(project, rev, tool_versions):
+        """Returns the key of the test of `project` at `rev` with `{ <tool>: <version> }`."""
+        key_parts = [project, rev, sorted(tool_versions.items())]
+        return hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()
+
+    def __contains__(self, key):
+        return key in self._passed
+
+    def add(self, key):
+        with self._lock:
+            self._passed.pop(key, None)
+            self._passed[key] = time.time()
+
+    def save(self):
+        """Writes the most recently passed tests to the cache file."""
+        with self._lock:
+            passed = dict(list(self._passed.items())[-self.max_entries :])
+        os.makedirs(osp.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f_cache:
+            json.dump(passed, f_cache)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def run_tests(config, tool_versions, jobs=1, test_cache=None):
+    # pylint: disable=unused-variable
+    """Builds, unit tests, and locally deploys all projects found in canary repos
+       and the starter repo produced by `oasis init`. Up to `jobs` canaries are fetched at
+       once. Their projects are then tested one at a time, since they share one chain and
+       would otherwise deploy with the same accounts. Raises once all canaries are tested
+       if any of them failed.
+       Canaries are skipped if they passed with the same rev and versions of the tools that
+       they exercise. These are the canary's declared `tools`, or else the `TEST_TOOLS` of
+       the kinds of projects that it contains."""
+    if not config.canaries:
+        return
 
-def get_cached_versions(s3):
-    """Returns the cached tools as `{ <tool name>: <version> }`."""
-    return _get_tools_in(s3, CACHE_BIN_PFX)
+    run("oasis", input="y\n", stdout=DEVNULL, check=False)  # gen config if needed
+    os.makedirs(CANARIES_DIR, exist_ok=True)
 
+    test_cache = test_cache or TestCache()
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        canary_tests = list(
+            pool.map(
+                lambda canary: _fetch_canary(canary, tool_versions, test_cache), config.canaries
+            )
+        )
+    canary_tests.append(_init_quickstart(tool_versions, test_cache))
+    results = []
+    try:
+        with oasis_chain():
+            for canary_test in canary_tests:
+                canary_results = canary_test.results + [
+                    _test_project(*project) for project in canary_test.projects
+                ]
+                if canary_test.key and all(result.error is None for result in canary_results):
+                    test_cache.add(canary_test.key)
+                results.extend(canary_results)
+    finally:
+        test_cache.save()
 
-def _get_tools_in(s3, prefix):
-    """Returns the `{ <tool name>: <version> }`s in the bucket under `prefix`."""
-    objs = s3.list_objects_v2(Bucket=BIN_BUCKET, Prefix=prefix).get("Contents", [])
-    return dict(parse_s3_key(obj["Key"]) for obj in objs)
+    failures = [result for result in results if result.error is not None]
+    for result in results:
+        status = "ok" if result.error is None else f"FAILED: {result.error}"
+        print(f"test {result.project}:{osp.relpath(result.manifest_dir, CANARIES_DIR)} {status}")
+    for result in failures:
+        print(f"! {result.project}:{result.manifest_dir}\n{result.output}")
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(results)} canary projects failed")
 
 
-def get_s3_key(prefix, tool, version):
-    """Returns the key for the tool and version under the provided prefix."""
-    return osp.join(prefix, f"{tool}-{version}")
+def _fetch_canary(canary, tool_versions, test_cache):
+    """Clones or updates `canary` and returns the `CanaryTest` of its projects."""
+    canary_dir = osp.join(CANARIES_DIR, canary.source.rsplit("/", 1)[-1])
+    try:
+        if osp.isdir(osp.join(canary_dir, ".git")):
+            run(
+                "git fetch origin && git reset --hard origin/master",
+                cwd=canary_dir,
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+            )
+        else:
+            run(f"git clone -q --depth 1 {canary.source} {canary_dir}", stdout=DEVNULL)
+        rev = run("git rev-parse HEAD", cwd=canary_dir, stdout=PIPE).stdout.strip()
+    except subprocess.CalledProcessError as err:
+        return CanaryTest(None, [], [TestResult(canary.source, canary_dir, err, "")])
+
+    manifests = {name: find_manifests(canary_dir, name) for name in TEST_STEPS}
+    tools = canary.tools
+    if tools is None:
+        tools = {tool for name, paths in manifests.items() if paths for tool in TEST_TOOLS[name]}
+    test_key = TestCache.key(canary.source, rev, {t: tool_versions.get(t) for t in tools})
+    if test_key in test_cache:
+        print(f"test {canary.source} passed at {rev[:7]} with the same tools")
+        return CanaryTest(None, [], [])
+    # Each manifest is tested individually because a canary repo might contain
+    # multiple projects.
+    projects = [
+        (canary.source, osp.join(canary_dir, osp.dirname(manifest)), steps)
+        for manifest_name, steps in TEST_STEPS.items()
+        for manifest in manifests[manifest_name]
+    ]
+    return CanaryTest(test_key, projects, [])
+
+
+def _init_quickstart(tool_versions, test_cache):
+    """Creates the starter repo with `oasis init` and returns its `CanaryTest`."""
+    tools = TEST_TOOLS["Cargo.toml"]
+    test_key = TestCache.key(MYPROJ, "", {t: tool_versions.get(t) for t in tools})
+    if test_key in test_cache:
+        print(f"test {MYPROJ} passed with the same tools")
+        return CanaryTest(None, [], [])
+
+    myproj_dir = osp.join(CANARIES_DIR, MYPROJ)
+    shutil.rmtree(myproj_dir, ignore_errors=True)
+    try:
+        run(f"oasis init -qq {myproj_dir}", cwd=CANARIES_DIR, stdout=PIPE, stderr=STDOUT)
+    except subprocess.CalledProcessError as err:
+        return CanaryTest(None, [], [TestResult(MYPROJ, myproj_dir, err, err.stdout)])
+    # In the quickstart, we can assume that the root contains only one project.
+    return CanaryTest(test_key, [(MYPROJ, myproj_dir, TEST_STEPS["Cargo.toml"])], [])
 
 
-def parse_s3_key(key):
-    """Parses the S3 object path into (name, ver)."""
-    return key.rsplit("/", 1)[-1].rsplit("-", 1)
+def _test_project(project, manifest_dir, steps):
+    """Runs `steps` in `manifest_dir` and returns their `TestResult`."""
+    output = []
+    try:
+        for step in steps:
+            step_run = run(step, cwd=manifest_dir, stdout=PIPE, stderr=STDOUT, check=False)
+            output.append(f"+ {step}\n{step_run.stdout}")
+            step_run.check_returncode()
+    except (OSError, subprocess.CalledProcessError) as err:
+        return TestResult(project, manifest_dir, err, "".join(output))
+    return TestResult(project, manifest_dir, None, "".join(output))
+
+
+def find_manifests(repo_dir, *names):
+    """Returns the paths of the files named one of `names` in the repo at `repo_dir`,
+       ordered like `names` and then by path. Vendored manifests are skipped."""
+    tracked_files = _ls_files(repo_dir)
+    return [
+        path
+        for name in names
+        for path in tracked_files
+        if osp.basename(path) == name and VENDORED_DIRS.isdisjoint(path.split("/")[:-1])
+    ]
+
+
+_LS_FILES_CACHE = {}  # (repo dir, HEAD rev): tracked files
+
+
+def _ls_files(repo_dir):
+    """Returns the sorted paths of the files tracked by the repo at `repo_dir`."""
+    head = _read_head_rev(repo_dir)
+    cache_key = (osp.abspath(repo_dir), head)
+    if head is None or cache_key not in _LS_FILES_CACHE:
+        try:
+            tracked_files = _read_git_index(repo_dir)
+        except (OSError, ValueError, struct.error):
+            ls_files = run("git ls-files -z", cwd=repo_dir, stdout=PIPE)
+            tracked_files = ls_files.stdout.split("\0")[:-1]
+        _LS_FILES_CACHE[cache_key] = sorted(set(tracked_files))
+    return _LS_FILES_CACHE[cache_key]
+
+
+def _read_head_rev(repo_dir):
+    """Returns the rev checked out in `repo_dir`, if it can be read without git."""
+    git_dir = osp.join(repo_dir, ".git")
+    try:
+        with open(osp.join(git_dir, "HEAD")) as f_head:
+            head = f_head.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[len("ref: ") :]
+        if osp.isfile(osp.join(git_dir, ref)):
+            with open(osp.join(git_dir, ref)) as f_ref:
+                return f_ref.read().strip()
+        with open(osp.join(git_dir, "packed-refs")) as f_packed_refs:
+            for line in f_packed_refs:
+                if line.rstrip().endswith(f" {ref}"):
+                    return line.split(" ", 1)[0]
+    except OSError:
+        pass
+    return None
+
+
+def _read_git_index(repo_dir):
+    """Returns the paths in the repo's index. Raises `ValueError` if the index is in a
+       format other than version 2 or 3, which is what git writes by default."""
+    with open(osp.join(repo_dir, ".git", "index"), "rb") as f_index:
+        index = f_index.read()
+    signature, version, num_entries = struct.unpack_from(">4sLL", index)
+    if signature != b"DIRC" or version not in (2, 3):
+        raise ValueError(f"unsupported git index: {signature} v{version}")
+    paths = []
+    pos = 12
+    for _ in range(num_entries):
+        # Each entry is 62 bytes of stat data, hash and flags, then the path. Version 3
+        # entries have two more bytes of flags if the extended flag is set.
+        (flags,) = struct.unpack_from(">H", index, pos + 60)
+        path_start = pos + (64 if flags & 0x4000 else 62)
+        path_end = index.index(b"\0", path_start)
+        paths.append(index[path_start:path_end].decode())
+        pos += (path_end - pos + 8) & ~7  # entries are NUL-padded to a multiple of 8 bytes
+    return paths
 
 
-def run(cmd, envs=None, check=True, **run_args):
-    penvs = dict(os.environ)
-    penvs["PATH"] = BIN_DIR + ":" + penvs["PATH"]
-    if envs:
-        penvs.update(envs)
-    print(f"+ {cmd}")
-    return subprocess.run(cmd, shell=True, env=penvs, check=check, encoding="utf8", **run_args)
+def get_head_versions(config):
+    """Returns { <tool-name>: <git-rev> } """
+    sources = sorted(config.sources())
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as pool:
+        source_revs = dict(zip(sources, pool.map(get_head_rev, sources)))
+    return {t.name: source_revs[t.source] for t in config.tools.values()}
 
 
-@contextmanager
-def s3_client():
-    """Yields a boto s3 client that has permissions to modify the toolstate bucket."""
-    aws_cred_names = ["aws_access_key_id", "aws_secret_access_key", "aws_session_token"]
-    aws_creds = run(".github/workflows/get-s3-creds.sh", stdout=PIPE).stdout.split("\t")
-    yield boto3.client("s3", **dict(zip(aws_cred_names, aws_creds)))
+def get_head_rev(source, timeout=LS_REMOTE_TIMEOUT, attempts=LS_REMOTE_ATTEMPTS):
+    """Returns the short rev of `source`'s master. Failed or hung probes are retried
+       with exponential backoff."""
+    for attempt in range(attempts):
+        try:
+            ls_remote = run(f"git ls-remote {source} master", stdout=PIPE, timeout=timeout)
+            return ls_remote.stdout.split("\t", 1)[0][:7]
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            if attempt == attempts - 1:
+                raise
+            time.sleep(2 ** attempt)
+    return ""
 
 
 @contextmanager
-def pushd(path):
-    orig_dir = os.getcwd()
-    os.makedirs(path, exist_ok=True)
-    os.chdir(path)
-    print(f"+ cd {osp.relpath(os.getcwd(), orig_dir)}")
+def oasis_chain():
+    env = {"PATH": f"{HOST_TARGET.bin_dir}:/usr/bin", "HOME": os.environ["HOME"]}
+    cp = subprocess.Popen(["oasis", "chain"], env=env, stdout=DEVNULL)
     try:
         yield
     finally:
-        print(f"+ cd {osp.relpath(orig_dir, os.getcwd())}")
-        os.chdir(orig_dir)
-
-
-@contextmanager
-def oasis_chain():
-    env = {"PATH": f"{BIN_DIR}:/usr/bin", "HOME": os.environ["HOME"]}
-    cp = subprocess.Popen(["oasis", "chain"], env=env, stdout=DEVNULL)
-    yield
-    cp.terminate()
-    cp.wait()
+        cp.terminate()
+        cp.wait()
 
 
 if __name__ == "__main__":